@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class PbiGroupIndex:
+    """
+    Group index over a column of a .pbi (e.g. holeNumber, tId, RefGroupID).
+
+    Rows are argsorted by key once, CSR style: the rows of the i-th key are
+    order[offsets[i]:offsets[i + 1]], in their original (file) order. Looking
+    up the rows of a key is a dict lookup plus a slice, instead of a fresh
+    scan over the whole pbi.
+    """
+    def __init__(self, keys):
+        """
+        :param keys: key of every pbi row, e.g. sset.index['holeNumber']
+        """
+        keys = np.asarray(keys)
+        self.order = np.argsort(keys, kind='mergesort')  # stable, keeps file order in groups
+        sorted_keys = keys[self.order]
+        starts = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+        if len(keys) > 0:
+            starts = np.concatenate(([0], starts))
+        self.keys = sorted_keys[starts]
+        self.offsets = np.concatenate((starts, [len(keys)])).astype(int)
+        self._positions = dict(zip(self.keys.tolist(), range(len(self.keys))))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def sizes(self):
+        """
+        Number of rows of each key, aligned with self.keys
+        """
+        return np.diff(self.offsets)
+
+    def rows(self, key):
+        """
+        Rows of a key, in file order. Empty if the key isn't present.
+        """
+        position = self._positions.get(key)
+        if position is None:
+            return self.order[:0]
+        return self.order[self.offsets[position]:self.offsets[position + 1]]
+
+    def countWhere(self, mask):
+        """
+        Count the rows of each key for which mask is True
+
+        :param mask: boolean array over all pbi rows
+        :return: counts aligned with self.keys
+        """
+        if len(self.keys) == 0:
+            return np.zeros((0, ), dtype=int)
+        return np.add.reduceat(np.asarray(mask, dtype=int)[self.order], self.offsets[:-1])
+
+    def sumWhere(self, values, mask=None):
+        """
+        Sum a pbi column over the rows of each key for which mask is True
+
+        :param values: numeric array over all pbi rows
+        :param mask: boolean array over all pbi rows, None for all rows
+        :return: float sums aligned with self.keys
+        """
+        if len(self.keys) == 0:
+            return np.zeros((0, ), dtype=float)
+        values = np.asarray(values, dtype=float)
+        if mask is not None:
+            values = np.where(mask, values, 0.)
+        return np.add.reduceat(values[self.order], self.offsets[:-1])
+
+    def sampleRows(self, random_state=np.random):
+        """
+        Pick one row of each key uniformly at random
+
+        :return: rows aligned with self.keys
+        """
+        picks = (random_state.random_sample(len(self.keys)) * self.sizes()).astype(int)
+        return self.order[self.offsets[:-1] + picks]
@@ -1,7 +1,159 @@
 from pbcore.io import SubreadSet
 import pandas as pd
 import numpy as np
-import operator
+import heapq
+import itertools
+import PbiGroupIndex as pgi
+import KineticsAccumulator as ka
+from poa import SequenceEncoding as se
+from poa import KmerOrientation as ko
+
+UINT64_MASK = (1 << 64) - 1
+
+
+def _zmwPriority(hole_number, salt):
+    """
+    Uniform pseudo-random priority in [0, 1) of a ZMW, the same for every
+    subread of the ZMW (splitmix64 of the salted holeNumber)
+    """
+    z = ((int(hole_number) + salt) * 0x9E3779B97F4A7C15) & UINT64_MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & UINT64_MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & UINT64_MASK
+    return (z ^ (z >> 31)) / float(1 << 64)
+
+
+def _groupMedians(groups, values, counts):
+    """
+    Median of values within each group, from a single sort
+
+    :param groups: group of each value
+    :param counts: number of values of each group, np.bincount(groups)
+    :return: median of each group, NaN for empty groups
+    """
+    ordered = values[np.lexsort((values, groups))].astype(float)
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    lower = (starts + (counts - 1) // 2)[present]
+    upper = (starts + counts // 2)[present]
+    medians = np.full(counts.shape, np.nan)
+    medians[present] = (ordered[lower] + ordered[upper]) / 2.
+    return medians
+
+
+def summarizeBaseKinetics(bases, ipds, pws):
+    """
+    Per-base mean, median and standard deviation of IPDs and PWs, with
+    bincount reductions over the raw base bytes instead of a groupby
+
+    :param bases: uint8 array of base bytes
+    :param ipds: IPD of each base
+    :param pws: PW of each base
+    :return: DataFrame indexed by base, with columns IPD_mean, PW_mean,
+             IPD_median, PW_median, IPD_std and PW_std
+    """
+    bases = np.asarray(bases, dtype=np.uint8)
+    counts = np.bincount(bases, minlength=256)
+    present = np.flatnonzero(counts)
+    columns = {}
+    for name, values in zip(ka.KINETICS, [ipds, pws]):
+        values = np.asarray(values)
+        sums = np.bincount(bases, weights=values, minlength=256)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+            deviations = values - means[bases]
+            squares = np.bincount(bases, weights=deviations * deviations, minlength=256)
+            stds = np.sqrt(squares / (counts - 1))  # ddof=1, like pandas
+        stds[counts < 2] = np.nan
+        columns[name + '_mean'] = means[present]
+        columns[name + '_median'] = _groupMedians(bases, values, counts)[present]
+        columns[name + '_std'] = stds[present]
+
+    index = pd.Index([chr(base) for base in present], name='base')
+    return pd.DataFrame(columns,
+                        index=index,
+                        columns=[name + stat
+                                 for stat in ['_mean', '_median', '_std']
+                                 for name in ka.KINETICS])
+
+
+def contextCodes(seq, context_size, lengths=None):
+    """
+    Code of the k-mer centered on each base, from the 2-bit k-mer encoding
+    (A0 C1 G2 T3, first base most significant) of KmerOrientation.kmerCodes
+
+    :param seq: sequence, or several reads laid end to end
+    :param context_size: odd k-mer size, so contexts are centered on a base
+    :param lengths: length of each read, so contexts don't span two reads.
+                    None for a single read.
+    :return: int64 context code of each base. -1 where the context runs off
+             the read or covers a base that isn't ACGT.
+    """
+    if context_size % 2 == 0:
+        raise ValueError('Context size must be odd, so contexts are centered on a base.')
+    half = context_size // 2
+    codes = np.full((len(seq), ), -1, dtype=np.int64)
+    kmers, _, starts = ko.kmerCodes(seq, context_size, return_positions=True)
+    codes[starts + half] = kmers.astype(np.int64)
+    if lengths is not None:
+        lengths = np.asarray(lengths, dtype=int)
+        positions = np.arange(len(seq)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        near_end = (positions < half) | (positions >= np.repeat(lengths, lengths) - half)
+        codes[near_end] = -1
+
+    return codes
+
+
+def contextLabels(context_size):
+    """
+    K-mer of each context code, see contextCodes
+
+    :return: list of 4^k strings, indexed by code
+    """
+    return [''.join(kmer) for kmer in itertools.product('ACGT', repeat=context_size)]
+
+
+def startFrames(read):
+    """
+    Movie frame at which each base of a subread starts, from its sf tag.
+    When the BAM keeps squashed pulses, sf holds one frame per pulse and
+    the bases are the pulses called in upper case in the pc tag.
+
+    :param read: subread record
+    :return: int64 start frame of each base
+    """
+    peer = read.peer
+    if not peer.has_tag('sf'):
+        raise ValueError('Time-resolved kinetics need subreads with the sf tag.')
+    frames = np.asarray(peer.get_tag('sf'), dtype=np.int64)
+    nbases = len(read.read(aligned=False))
+    if len(frames) != nbases and peer.has_tag('pc'):
+        pulses = se.byteView(peer.get_tag('pc'))
+        frames = frames[(pulses >= ord('A')) & (pulses <= ord('Z'))]
+    if len(frames) != nbases:
+        raise ValueError('The sf tag of ' + read.readName + ' does not match its bases.')
+    return frames
+
+
+def timeBaseCodes(reads, sequence, time_bin, ntime_bins):
+    """
+    Group of each base on a (movie time bin x base) grid: time bin * 4 plus
+    the 2-bit code of the base (A0 C1 G2 T3)
+
+    :param reads: subread records, laid end to end in sequence
+    :param sequence: bases of the reads
+    :param time_bin: width of the time bins, in seconds
+    :param ntime_bins: number of time bins
+    :return: int64 group of each base. -1 for bases after the last time bin
+             and bases that aren't ACGT.
+    """
+    seconds = np.concatenate([startFrames(read) / float(read.readGroupInfo.FrameRate)
+                              for read in reads])
+    bins = (seconds // time_bin).astype(np.int64)
+    bases = se.TWO_BIT[se.byteView(sequence)].astype(np.int64)
+    codes = bins * 4 + bases
+    codes[(bins >= ntime_bins) | (bases == 4)] = -1
+    return codes
+
 
 class kinetics:
     """
@@ -11,17 +163,29 @@ class kinetics:
     def __init__(self, sset_path,
                        nreads=None,
                        samples_per_read=None,
-                       unique_zmws=False):
+                       unique_zmws=False,
+                       block_size=1000,
+                       sampling='random'):
+        """
+        :param block_size: number of reads whose kinetics are pulled into
+                           contiguous arrays at once
+        :param sampling: 'random' draws pbi rows and fetches each read by
+                         index. 'sequential' scans the BAMs once in file
+                         order and keeps a reservoir of reads, see
+                         _reservoirSample.
+        """
         self.sset_path = sset_path
         self.sset = SubreadSet(self.sset_path)
         self.nreads = nreads
         self.samples_per_read = samples_per_read
         self.unique_zmws = unique_zmws
+        self.block_size = block_size
+        self.sampling = sampling
+        self._check_sampling()
 
     def _getUniqueSubreadIndices(self, index):
-        fn = lambda df: np.random.choice(df.index, size=1, replace=False)
-        indices = index.groupby(by=['holeNumber'], as_index=False).apply(fn)
-        indices = np.concatenate(indices).ravel()
+        zmw_index = pgi.PbiGroupIndex(index['holeNumber'].values)
+        indices = index.index.values[zmw_index.sampleRows()]
         return index.loc[indices]
 
     def _getSubreadIndices(self, index):
@@ -36,8 +200,129 @@ class kinetics:
 
         return index.index.values
 
+    def summarizeKinetics(self, online=False):
+        """
+        Per-base mean, median and standard deviation of IPD and PW
+
+        :param online: stream blocks into a KineticsAccumulator instead of
+                       keeping every sampled base in memory. Medians are then
+                       read from its histograms, see KineticsAccumulator.
+        :return: DataFrame indexed by base
+        """
+        if online:
+            return self.accumulateKinetics().summary()
+
+        blocks = list(self._iterBlocks())
+        if blocks:
+            bases, ipds, pws = [np.concatenate(arrays) for arrays in zip(*blocks)]
+        else:
+            bases, ipds, pws = [np.zeros((0, ), dtype=dtype)
+                                for dtype in [np.uint8, int, int]]
+
+        return summarizeBaseKinetics(bases, ipds, pws)
+
+    def accumulateKinetics(self, accumulator=None):
+        """
+        Add the kinetics of the sampled reads to a per-base accumulator, one
+        block at a time, so memory doesn't grow with the number of reads.
+        Accumulators of different SubreadSets or workers can be merged.
+
+        :param accumulator: KineticsAccumulator to add to. A new one by default.
+        :return: the accumulator
+        """
+        if accumulator is None:
+            accumulator = ka.KineticsAccumulator()
+        for bases, ipds, pws in self._iterBlocks():
+            accumulator.add(bases, ipds, pws)
+
+        return accumulator
+
+    def summarizeContextKinetics(self, context_size=5):
+        """
+        Mean, median and standard deviation of IPD and PW by the k-mer
+        context centered on each base
+
+        :param context_size: odd k-mer size
+        :return: DataFrame indexed by context, for the contexts observed
+        """
+        accumulator = self.accumulateContextKinetics(context_size)
+        return accumulator.summary(contextLabels(context_size), name='context')
+
+    def accumulateContextKinetics(self, context_size=5, accumulator=None):
+        """
+        Add the kinetics of the sampled reads to a dense table of 4^k
+        k-mer contexts, one block at a time. Bases without a full context
+        (read ends, non-ACGT bases) are left out.
+
+        :param context_size: odd k-mer size
+        :param accumulator: KineticsAccumulator with 4^k groups to add to.
+                            A new one by default.
+        :return: the accumulator
+        """
+        if accumulator is None:
+            accumulator = ka.KineticsAccumulator(ngroups=4**context_size)
+        grouping = lambda reads, sequence, lengths: contextCodes(sequence, context_size, lengths)
+        for contexts, ipds, pws in self._iterBlocks(grouping):
+            full = contexts >= 0
+            accumulator.add(contexts[full], ipds[full], pws[full])
+
+        return accumulator
+
+    def summarizeTimeKinetics(self, time_bin=600., max_time=30 * 3600.):
+        """
+        Mean, median and standard deviation of IPD and PW of each base, in
+        windows of movie time, to follow drift from photodamage or reagent
+        depletion over the movie
+
+        :param time_bin: width of the time windows, in seconds
+        :param max_time: end of the last window, in seconds
+        :return: DataFrame indexed by (time, base), where time is the start
+                 of the window in seconds, for the windows observed
+        """
+        accumulator = self.accumulateTimeKinetics(time_bin, max_time)
+        ntime_bins = accumulator.ngroups // 4
+        labels = [(time * time_bin, base)
+                  for time in range(ntime_bins)
+                  for base in 'ACGT']
+        summary = accumulator.summary(labels, name=None)
+        summary.index = pd.MultiIndex.from_tuples(list(summary.index), names=['time', 'base'])
+        return summary
+
+    def accumulateTimeKinetics(self, time_bin=600., max_time=30 * 3600., accumulator=None):
+        """
+        Add the kinetics of the sampled reads to a fixed (time window x base)
+        grid, one block at a time. Each base is placed in time by its sf
+        start frame and the FrameRate of its read group, so no per-pulse
+        data is kept. Bases after max_time are left out.
+
+        :param time_bin: width of the time windows, in seconds
+        :param max_time: end of the last window, in seconds
+        :param accumulator: KineticsAccumulator with 4 groups per window to
+                            add to. A new one by default.
+        :return: the accumulator
+        """
+        ntime_bins = int(np.ceil(max_time / time_bin))
+        if accumulator is None:
+            accumulator = ka.KineticsAccumulator(ngroups=4 * ntime_bins)
+        grouping = lambda reads, sequence, lengths: timeBaseCodes(reads, sequence, time_bin, ntime_bins)
+        for groups, ipds, pws in self._iterBlocks(grouping):
+            kept = groups >= 0
+            accumulator.add(groups[kept], ipds[kept], pws[kept])
+
+        return accumulator
+
+    def _iterBlocks(self, grouping=None):
+        """
+        Yield the (bases, ipds, pws) of the sampled reads, block by block
+
+        :param grouping: yield groups (k-mer contexts, ...) instead of
+                         bases, see _extractReads
+        """
+        if self.sampling == 'sequential':
+            for block in self._scanBlocks(grouping):
+                yield block
+            return
 
-    def summarizeKinetics(self):
         # get indices of subreads to scrape kinetics from
         index = pd.DataFrame.from_records(self.sset.index)
 
@@ -45,53 +330,131 @@ class kinetics:
         # If the unique_zmws flag was triggered, it only
         # contains one randomly selected read per ZMW. If
         # the nreads flag was triggered, we randomly subsampled.
-        # Now we iterate through the read indices, and extract
-        # kinetics.
-        sampled_read_ixs = self._getSubreadIndices(index)
-        if self.samples_per_read != None:
-            storage_per_read = self.samples_per_read
+        # Now we extract kinetics block by block, in pbi order
+        # so reads are fetched close to file order.
+        sampled_read_ixs = np.sort(self._getSubreadIndices(index))
+        for start in range(0, len(sampled_read_ixs), self.block_size):
+            yield self._extractBlock(sampled_read_ixs[start:start+self.block_size],
+                                     grouping)
+
+    def _scanBlocks(self, grouping=None):
+        """
+        Yield the (bases, ipds, pws) of reads sampled in one sequential scan
+        """
+        if self.nreads is None and not self.unique_zmws:
+            # every read is kept, no need to hold a reservoir
+            reads = []
+            for read in self.sset:
+                reads.append(read)
+                if len(reads) == self.block_size:
+                    yield self._extractReads(reads, grouping)
+                    reads = []
+            if reads:
+                yield self._extractReads(reads, grouping)
+            return
+
+        reads = self._reservoirSample()
+        for start in range(0, len(reads), self.block_size):
+            yield self._extractReads(reads[start:start+self.block_size], grouping)
+
+    def _reservoirSample(self):
+        """
+        Sample reads in a single pass over the BAMs in file order, with the
+        same guarantees as _getSubreadIndices: nreads reads drawn uniformly
+        without replacement, or, with unique_zmws, nreads ZMWs drawn
+        uniformly and one subread drawn uniformly from each.
+
+        Every read (or ZMW) gets a random priority and the nreads lowest
+        priorities are kept. A ZMW's priority is a hash of its holeNumber, so
+        all of its subreads share it and ZMWs with more subreads aren't
+        favoured. Subreads of a kept ZMW replace each other by Algorithm R.
+
+        :return: list of sampled reads
+        """
+        salt = np.random.randint(0, 2**31)
+        heap = []  # (-priority, key) of the kept reads or ZMWs
+        kept = {}  # key -> [subreads seen, sampled read]
+        for ordinal, read in enumerate(self.sset):
+            if self.unique_zmws:
+                key = read.holeNumber
+                if key in kept:
+                    kept[key][0] += 1
+                    if np.random.random_sample() * kept[key][0] < 1:
+                        kept[key][1] = read
+                    continue
+                # a ZMW missing from the reservoir is either new or out for
+                # good: the cutoff only falls and its subreads share a priority
+                priority = _zmwPriority(key, salt)
+            else:
+                key = ordinal
+                priority = np.random.random_sample()
+
+            if self.nreads is not None and len(kept) >= self.nreads:
+                if not heap or priority >= -heap[0][0]:
+                    continue
+                _, evicted = heapq.heapreplace(heap, (-priority, key))
+                del kept[evicted]
+            elif self.nreads is not None:
+                heapq.heappush(heap, (-priority, key))
+            kept[key] = [1, read]
+
+        return [read for _, read in kept.values()]
+
+    def _extractBlock(self, read_ixs, grouping=None):
+        """
+        Pull the kinetics of a block of reads, fetched by pbi row
+
+        :param read_ixs: pbi rows of the reads
+        :return: (bases, ipds, pws), see _extractReads
+        """
+        return self._extractReads([self.sset[read_ix] for read_ix in read_ixs],
+                                  grouping)
+
+    def _extractReads(self, reads, grouping=None):
+        """
+        Pull the bases, IPDs and PWs of a block of reads into contiguous
+        arrays. If samples_per_read is set, that many bases of each read
+        are drawn with replacement.
+
+        :param reads: subread records
+        :param grouping: function of (reads, sequence, lengths), giving the
+                         group of each base of the reads laid end to end
+                         (-1 to leave a base out). Returned instead of the
+                         bases, e.g. contextCodes.
+        :return: (bases, ipds, pws). bases are the uint8 bytes of the sequences.
+        """
+        sequence = ''.join(read.read(aligned=False) for read in reads)
+        ipds = [read.IPD(aligned=False) for read in reads]
+        lengths = np.array([len(ipd) for ipd in ipds], dtype=int)
+        if grouping is None:
+            bases = se.byteView(sequence)
         else:
-            storage_per_read = 2000
-        kinetics_table = np.zeros(len(sampled_read_ixs)*storage_per_read,
-                                  dtype=[('base', 'S1'),
-                                         ('IPD', int),
-                                         ('PW', int)])
-        cntr = 0
-        for j, read_ix in enumerate(sampled_read_ixs):
-            read = self.sset[read_ix]
-            kin = np.array(zip(list(read.read(aligned=False)),
-                           read.IPD(aligned=False),
-                           read.PulseWidth(aligned=False)),
-                           dtype=[('base', 'S1'),
-                                  ('IPD', int),
-                                  ('PW', int)])
-            if self.samples_per_read != None:
-                kin = np.random.choice(kin, self.samples_per_read)
-            l = len(kin)
-            if l + cntr > kinetics_table.shape[0]:
-                kinetics_table = self._resize_array(kinetics_table,
-                                                    (len(sampled_read_ixs)-j)*self.samples_per_read)
-            kinetics_table[cntr:cntr+l] = kin
-            cntr += kin.shape[0]
-
-        kinetics_summary = pd.DataFrame.from_records(kinetics_table)
-        gb = kinetics_summary.groupby(by='base')
-        mean = gb.mean()
-        median = gb.median()
-        std = gb.std()
-        std.rename({'IPD': 'IPD_std',
-                    'PW': 'PW_std'},
-                   axis='columns',
-                   inplace=True)
-        summary = mean.merge(median, left_index=True, right_index=True, suffixes=('_mean', '_median'), )
-        summary = summary.merge(std, left_index=True, right_index=True)
+            bases = grouping(reads, sequence, lengths)
+        ipds = np.concatenate(ipds)
+        pws = np.concatenate([read.PulseWidth(aligned=False) for read in reads])
+        if self.samples_per_read is not None:
+            positions = self._samplePositions(lengths, self.samples_per_read)
+            bases, ipds, pws = bases[positions], ipds[positions], pws[positions]
 
-        return summary
+        return bases, ipds, pws
+
+    def _samplePositions(self, lengths, samples_per_read):
+        """
+        Draw samples_per_read positions, with replacement, from each read of
+        a block laid end to end. Empty reads are skipped.
+
+        :param lengths: length of each read
+        :return: positions into the concatenated block
+        """
+        starts = np.cumsum(lengths) - lengths
+        sampled = np.repeat(np.flatnonzero(lengths > 0), samples_per_read)
+        offsets = (np.random.random_sample(sampled.size) * lengths[sampled]).astype(int)
+        return starts[sampled] + offsets
 
-    def _resize_array(self, arr, increase_by):
+    def _check_sampling(self):
         """
-        Resize NumPy array if necessary
+        Make sure sampling is either 'random' or 'sequential'
         """
-        new_size = tuple(map(operator.add, arr.shape, (increase_by, )))
-        arr = np.resize(arr, new_size)
-        return arr
\ No newline at end of file
+        if self.sampling not in ['random', 'sequential']:
+            raise ValueError("Sampling must be either 'random' or 'sequential'. "
+                             "No other options are currently supported.")
@@ -1,14 +1,40 @@
 import POA as poa
+import ConsensusTensorStore as cts
+import PoaCache as pc
+import SequenceEncoding as se
+import TensorReservoir as tr
 import numpy as np
 import pandas as pd
+import multiprocessing
+import collections
 import logging
+from biotk.libs.PbiGroupIndex import PbiGroupIndex
 from pbcore.io import (SubreadSet,
-                       ReferenceSet)
+                       ReferenceSet,
+                       FastaRecord)
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
 
-class SubreadSetCircularConsensusTensors:
+_worker_builder = None  # per-process SubreadSetCircularConsensusTensors used by pool workers
+
+# builder attributes a pool worker needs to build the tensors of a ZMW task
+_WORKER_ATTRIBUTES = ['sset_path',
+                      'seed',
+                      'tensors_context_width',
+                      'tensors_collection_mode',
+                      'tensors_per_poa',
+                      'tensors_dtype',
+                      'poa_feature_dtype',
+                      'release_poa',
+                      'kinetics_scales',
+                      'kinetics_rescale_mode',
+                      'poa_alignment_mode',
+                      'poa_band_width',
+                      'poa_cache',
+                      'prefetch_zmws']
+
+class SubreadSetCircularConsensusTensors(object):
     """
     Class constructs ConsensusTensorLists from ZMWs in a particular
     subreadset.
@@ -19,6 +45,13 @@ class SubreadSetCircularConsensusTensors:
     :param n_zmws_sample: Number of ZMWs to produce ConsensusTensorLists. None uses all
                           ZMWs.
     :param min_coverage_depth: Minimum required coverage. Defaults to depth of 3.
+    :param max_length_cv: Reject ZMWs whose adapter-flanked subread lengths have a
+                          coefficient of variation above this, e.g. 0.1. Inconsistent
+                          lengths rarely give a usable consensus. None does not filter.
+    :param min_read_qual: Reject ZMWs whose mean subread readQual is below this. None does
+                          not filter.
+    :param zmw_selection: 'random' draws n_zmws_sample ZMWs passing the screen at random.
+                          'ranked' takes those with the most consistent subread lengths.
     :param coverage_depth: Specific coverage slice. If selected ZMW has higher coverage,
                            subreads are randomly subsample to coverage_depth value. None
                            does not apply filter, and lets everything > min_coverage_depth
@@ -30,11 +63,47 @@ class SubreadSetCircularConsensusTensors:
     :param tensors_subsample_count: returns a particular number of randomly-selected
                                     ConsensusTensor objects. If more samples are requested than
                                     exist, returns max possible number.
+    :param tensors_dtype: float dtype of the tensors, e.g. np.float32 to halve their memory.
+    :param poa_feature_dtype: integer dtype of each POA's feature vector, e.g. np.uint16.
+    :param release_poa: If True, each ConsensusTensorList drops its POA graph, MSA strings
+                        and subreads once its tensors are built.
     :param kinetics_summary: IPD and PW summary stats for rescaling the IPD and PW slices of
                              each ConsensusTensor. The kinetics class from QuickKinetics is
                              probably useful here. Expected data structure matches returned
                              datastructure of kinetics.summarizeKinetics() from the
                              QuickKinetics.py.
+    :param kinetics_rescale_mode: 'mean' divides the cumulative PW and IPD of each base by
+                                  its mean. 'zscore' z-scores them against the by-base
+                                  distributions, see rescaleTensorArray.
+    :param poa_alignment_mode: 'full', 'banded' or 'anchored'. Banded alignment restricts the
+                               DP of each subread to a band around the diagonal. Anchored
+                               alignment chains exact k-mer matches to the consensus path
+                               and only runs DP between them, see POA.
+    :param poa_band_width: band half-width for 'banded' mode. None adapts it to the indel
+                           rate of the ZMW's subreads.
+    :param poa_cache_dir: Directory of a PoaCache. ZMWs whose subreads and POA parameters
+                          match a cached entry skip alignment, so runs that only change the
+                          tensor or rescaling options reuse earlier POAs. Subsampling with
+                          coverage_depth needs a seed to pick the same subreads again.
+    :param poa_cache_max_bytes: size bound of the POA cache, least recently used entries
+                                are evicted past it. None for no bound.
+    :param n_workers: Number of processes to build tensors with. ZMWs are handed to a
+                      process pool in batches of zmws_per_batch, each worker opens its own
+                      SubreadSet, and only tensor and label arrays are sent back. With more
+                      than one worker, the constructor fills consensus_tensor_arrays with
+                      (tensors, labels) tuples, see makeConsensusTensorArrays, and leaves
+                      consensus_tensor_lists None.
+    :param zmws_per_batch: Number of ZMWs handed to a worker at a time.
+    :param prefetch_zmws: Number of ZMWs whose subreads a background thread decodes ahead
+                          of the POA, see prefetchSubreads. Pool workers prefetch within
+                          their batches, from their own SubreadSet handle. 0 fetches each
+                          ZMW's subreads when it's needed.
+    :param seed: Random seed. ZMW selection is seeded once, and each ZMW's subread
+                 subsampling, POA and loci selection is seeded from (seed, holeNumber), so
+                 results don't depend on n_workers. None leaves numpy's global state alone.
+    :param streaming: If True, nothing is built in the constructor and consensus_tensor_lists
+                      and consensus_tensor_arrays are None. Use iterTensorLists() to build tensors ZMW by ZMW with flat
+                      peak memory.
 
     """
 
@@ -42,25 +111,93 @@ class SubreadSetCircularConsensusTensors:
                        ref=None,
                        n_zmws_sample=None,
                        min_coverage_depth=3,
+                       max_length_cv=None,
+                       min_read_qual=None,
+                       zmw_selection='random',
                        coverage_depth=None,
                        tensors_context_width=0,
                        tensors_collection_mode='standard',
                        tensors_per_poa=None,
-                       kinetics_summary=None):
+                       tensors_dtype=float,
+                       poa_feature_dtype=int,
+                       release_poa=False,
+                       kinetics_summary=None,
+                       kinetics_rescale_mode='mean',
+                       poa_alignment_mode='full',
+                       poa_band_width=None,
+                       poa_cache_dir=None,
+                       poa_cache_max_bytes=None,
+                       n_workers=1,
+                       zmws_per_batch=16,
+                       prefetch_zmws=0,
+                       seed=None,
+                       streaming=False):
 
         self.sset_path = sset_path
         self.sset = SubreadSet(sset_path)
         self.pbi = pd.DataFrame.from_records(self.sset.index)
+        self.zmw_index = PbiGroupIndex(self.pbi['holeNumber'].values)
         self.ref = ref
         self.n_zmws_sample = n_zmws_sample
         self.min_coverage_depth = min_coverage_depth
+        self.max_length_cv = max_length_cv
+        self.min_read_qual = min_read_qual
+        self.zmw_selection = zmw_selection
+        self._check_zmw_selection()
         self.coverage_depth = coverage_depth
         self.tensors_context_width = tensors_context_width
         self.tensors_collection_mode = tensors_collection_mode
         self.tensors_per_poa = tensors_per_poa
+        self.tensors_dtype = tensors_dtype
+        self.poa_feature_dtype = poa_feature_dtype
+        self.release_poa = release_poa
         self.kinetics_summary = kinetics_summary
+        self.kinetics_rescale_mode = kinetics_rescale_mode
+        self._check_kinetics_rescale_mode()
+        self.kinetics_scales = None
+        if self.kinetics_summary is not None:
+            # align by-base means and stds to the tensor base order once per run
+            self.kinetics_scales = kineticsScales(self.kinetics_summary)
+        self.poa_alignment_mode = poa_alignment_mode
+        self.poa_band_width = poa_band_width
+        self.poa_cache = None
+        if poa_cache_dir is not None:
+            self.poa_cache = pc.PoaCache(poa_cache_dir, max_bytes=poa_cache_max_bytes)
+        self.n_workers = n_workers
+        self.zmws_per_batch = zmws_per_batch
+        self.prefetch_zmws = prefetch_zmws
+        self.seed = seed
+        if self.seed is not None:
+            np.random.seed(self.seed)
         self.zmws = self.selectZMWs()
-        self.consensus_tensor_lists = self.makeConsensusTensorLists()
+        self.consensus_tensor_lists = None
+        self.consensus_tensor_arrays = None
+        if not streaming and self.n_workers > 1:
+            self.consensus_tensor_arrays = self.makeConsensusTensorArrays()
+        elif not streaming:
+            self.consensus_tensor_lists = self.makeConsensusTensorLists()
+
+    def _workerConfig(self):
+        """
+        Parameters a pool worker needs to build tensors, without the
+        SubreadSet handle, pbi or built tensors. Workers open their own
+        SubreadSet, and subread indices are sent along with each ZMW.
+
+        :return: dict of _WORKER_ATTRIBUTES, plus ref as a FastaRecord
+        """
+        config = dict((attribute, getattr(self, attribute)) for attribute in _WORKER_ATTRIBUTES)
+        config['ref'] = None
+        if self.ref is not None:
+            config['ref'] = FastaRecord(self.ref.header, str(self.ref.sequence))
+        return config
+
+    def _seedZmw(self, zmw):
+        """
+        Seed numpy's global random state from the run seed and the ZMW, so each
+        ZMW's random choices are the same whichever process handles it.
+        """
+        if self.seed is not None:
+            np.random.seed([self.seed, zmw])
 
     def filterSubreads(self, subreads_pbi):
         """
@@ -79,83 +216,467 @@ class SubreadSetCircularConsensusTensors:
 
     def rescaleTensors(self, tensor_list):
         """
-        If kinetics summary info was provided, rescale the kinetics by average behavior
+        If kinetics summary info was provided, rescale the kinetics of all the
+        list's tensors at once, see ConsensusTensorList.rescaleKinetics.
 
         :return: tensor list
         """
-        if self.kinetics_summary is None:
+        if self.kinetics_scales is None:
             return tensor_list
 
-        # PWs are the first layer
-        for index, tensor in enumerate(tensor_list.consensus_tensor_list):
-            k = self.kinetics_summary
-            # reindex if kinetics summary has different base order than tensor.
-            # For speed, do a bunch of numpy-specific matrix manipulation to
-            # carry out the by-element division.
-            # The concept is simple, however. Divide each cumulative sum of base
-            # frames by the mean number of frames per PW and IPD, respectively.
-            # This weights the kinetics in terms of coverage.
-
-            # Start with PWs
-            k = k.reindex(list(tensor_list.baseOrder[0]))
-            cum_pws = tensor.tensor[:, :, 1]
-            cum_pws.ravel()
-            mean_pws = k['PW_mean'].ravel()
-            repeats = cum_pws.size / mean_pws.size
-            mean_pws = np.repeat(mean_pws, repeats).reshape(cum_pws.shape)
-            tensor.tensor[:, :, 1] = cum_pws / mean_pws
-
-            # Do the same with IPDs
-            cum_ipds = tensor.tensor[:, :, 2]
-            cum_ipds.ravel()
-            mean_ipds = k['IPD_mean'].ravel()
-            repeats = cum_ipds.size / mean_ipds.size
-            mean_ipds = np.repeat(mean_ipds, repeats).reshape(cum_ipds.shape)
-            tensor.tensor[:, :, 2] = cum_ipds / mean_ipds
-
-            # update the list item
-            tensor_list.consensus_tensor_list[index] = tensor
-
+        tensor_list.rescaleKinetics(self.kinetics_scales, mode=self.kinetics_rescale_mode)
         return tensor_list
 
     def makeConsensusTensorLists(self):
         """
-        For each selected ZMW, generate its respective ConsensusTensorList
-        :return:
+        For each selected ZMW, generate its respective ConsensusTensorList.
+        The lists hold their POAs, so they are built in this process.
+        :return: dict of ConsensusTensorList by ZMW
         """
         consensus_tensor_lists = {}
-        gb = self.pbi.groupby(by=['holeNumber'])
-        for zmw in self.zmws:
-            gb.groups[zmw]
-            subreads_pbi = self.pbi.iloc[gb.groups[zmw]]
-            subreads_pbi = subreads_pbi[subreads_pbi['contextFlag'] == 3]  # make sure adapters flank
-            subread_indices = self.filterSubreads(subreads_pbi)
+        tasks = self._zmwTasks()
+        for zmw, subread_indices, subreads in self._iterSubreads(tasks):
+            consensus_tensor_lists[zmw] = self.makeZmwTensorList(zmw,
+                                                                 subread_indices,
+                                                                 subreads=subreads)
+
+        return consensus_tensor_lists
+
+    def makeConsensusTensorArrays(self):
+        """
+        For each selected ZMW, build its stacked tensor and label arrays,
+        across a process pool when n_workers > 1, see iterTensorLists.
+        :return: dict of (tensors, labels) by ZMW
+        """
+        consensus_tensor_arrays = {}
+        for zmw, tensors, labels in self.iterTensorLists():
+            consensus_tensor_arrays[zmw] = (tensors, labels)
+
+        return consensus_tensor_arrays
+
+    def iterTensorLists(self, with_loci=False, skip_zmws=None):
+        """
+        Lazily build the tensors of each selected ZMW. Only the tensor and
+        label arrays are kept, and the ZMW's POA graph, MSA strings and
+        subreads are released before moving on, so memory doesn't grow with
+        the number of ZMWs sampled.
+
+        :param with_loci: also yield the MSA column of each tensor
+        :param skip_zmws: collection of ZMWs not to build, e.g. ones already written
+        :return: generator of (zmw, tensors, labels), or (zmw, tensors, labels, loci)
+        """
+        tasks = self._zmwTasks()
+        if skip_zmws is not None:
+            tasks = [task for task in tasks if task[0] not in skip_zmws]
+        if self.n_workers > 1:
+            results = self._poolTensors(tasks)
+        else:
+            results = self._serialTensors(tasks)
+        for zmw, tensors, labels, loci in results:
+            if with_loci:
+                yield zmw, tensors, labels, loci
+            else:
+                yield zmw, tensors, labels
+
+    def _serialTensors(self, tasks):
+        """
+        Build ZMW tasks one at a time in this process
+
+        :return: generator of (zmw, tensors, labels, loci)
+        """
+        for zmw, subread_indices, subreads in self._iterSubreads(tasks):
+            tensor_list = self.makeZmwTensorList(zmw,
+                                                 subread_indices,
+                                                 tensor_objects=False,
+                                                 subreads=subreads)
+            result = (zmw, tensor_list.tensors, tensor_list.labels, tensor_list.loci)
+            del tensor_list
+            yield result
+
+    def writeTensorShards(self, output_dir,
+                                shard_size=100000,
+                                dtype=np.float32):
+        """
+        Stream the tensors of every selected ZMW into memory-mappable shards,
+        see ConsensusTensorStore.ConsensusTensorShardWriter. ZMWs already in
+        the manifest of output_dir are skipped, so an interrupted extraction
+        picks up after the last completed ZMW. Resuming requires the same seed,
+        so the same ZMWs and subreads are selected.
+
+        :return: ConsensusTensorShardWriter
+        """
+        if self.seed is None:
+            log.warning('No seed set. A resumed extraction will select different ZMWs.')
+        writer = cts.ConsensusTensorShardWriter(output_dir,
+                                                shard_size=shard_size,
+                                                dtype=dtype)
+        for zmw, tensors, labels, loci in self.iterTensorLists(with_loci=True,
+                                                               skip_zmws=writer.completed_zmws):
+            writer.write(zmw, tensors, labels, loci)
+        writer.close()
+        return writer
+
+    def _iterSubreads(self, tasks):
+        """
+        Subreads of each ZMW task, fetched in the background when
+        prefetch_zmws is set
+
+        :return: generator of (zmw, subread pbi rows, subreads)
+        """
+        if self.prefetch_zmws > 0:
+            # closed explicitly, so the prefetch thread is done with self.sset
+            # as soon as the caller stops iterating
+            prefetched = prefetchSubreads(self.sset, tasks, prefetch=self.prefetch_zmws)
+            try:
+                for task in prefetched:
+                    yield task
+            finally:
+                prefetched.close()
+            return
+        for zmw, subread_indices in tasks:
+            yield zmw, subread_indices, self.sset[list(subread_indices)]
+
+    def makeZmwTensorList(self, zmw, subread_indices, tensor_objects=True, subreads=None):
+        """
+        Build the rescaled ConsensusTensorList of a single ZMW
+
+        :param zmw: holeNumber
+        :param subread_indices: pbi rows of the subreads to use
+        :param tensor_objects: see ConsensusTensorList
+        :param subreads: already fetched subreads of subread_indices, e.g. from
+                         prefetchSubreads. Fetched from the SubreadSet if None.
+        :return: ConsensusTensorList
+        """
+        self._seedZmw(zmw)
+        if subreads is None:
             subreads = self.sset[list(subread_indices)]
+        tensor_list = ConsensusTensorList(subreads,
+                                          ref=self.ref,
+                                          context_width=self.tensors_context_width,
+                                          collection_mode=self.tensors_collection_mode,
+                                          subsample_count=self.tensors_per_poa,
+                                          tensor_objects=tensor_objects,
+                                          alignment_mode=self.poa_alignment_mode,
+                                          band_width=self.poa_band_width,
+                                          cache=self.poa_cache,
+                                          tensor_dtype=self.tensors_dtype,
+                                          feature_dtype=self.poa_feature_dtype,
+                                          release_poa=self.release_poa)
+        return self.rescaleTensors(tensor_list)
+
+    def iterCoverageSweeps(self, min_depth=3):
+        """
+        For each selected ZMW, build the plurality consensus and tensors at
+        every coverage depth from min_depth up to the ZMW's subread count,
+        from a single POA graph per ZMW, see coverageSweep. Subreads are
+        added in the order filterSubreads picked them.
+
+        :param min_depth: first depth of each sweep
+        :return: generator of (zmw, depth, plurality consensus, tensors, labels)
+        """
+        for zmw, subread_indices, subreads in self._iterSubreads(self._zmwTasks()):
+            self._seedZmw(zmw)
+            sweep = coverageSweep(subreads,
+                                  min_depth=min_depth,
+                                  ref=self.ref,
+                                  context_width=self.tensors_context_width,
+                                  collection_mode=self.tensors_collection_mode,
+                                  subsample_count=self.tensors_per_poa,
+                                  tensor_objects=False,
+                                  alignment_mode=self.poa_alignment_mode,
+                                  band_width=self.poa_band_width,
+                                  cache=self.poa_cache,
+                                  tensor_dtype=self.tensors_dtype,
+                                  feature_dtype=self.poa_feature_dtype)
+            for depth, tensor_list in sweep:
+                self.rescaleTensors(tensor_list)
+                yield (zmw,
+                       depth,
+                       tensor_list.PluralityConsensus[1].replace('-', ''),
+                       tensor_list.tensors,
+                       tensor_list.labels)
+
+    def sampleBalancedTensors(self, tensors_per_label, stop_when_full=False):
+        """
+        Draw a class-balanced training set across all selected ZMWs, see
+        TensorReservoir.StratifiedTensorReservoir. Every full-window locus of
+        each ZMW is offered once, so there are no duplicates, and only the
+        accepted tensors are copied out of the ZMW's column summary.
+
+        :param tensors_per_label: number of tensors to keep of each of A, C, G, T and -
+        :param stop_when_full: stop at the first ZMW after which every label has
+                               tensors_per_label tensors, instead of sampling
+                               uniformly over every selected ZMW. Needs far fewer
+                               POAs, at the cost of favoring early ZMWs, which are
+                               in random order with 'random' zmw_selection.
+                               Without it, every selected ZMW is still aligned,
+                               so bound the POA count with n_zmws_sample.
+        :return: StratifiedTensorReservoir
+        """
+        width = 1 + 2 * self.tensors_context_width
+        reservoir = tr.StratifiedTensorReservoir(tensors_per_label,
+                                                 (5, width, 3),
+                                                 dtype=self.tensors_dtype,
+                                                 seed=self.seed)
+        for zmw, subread_indices, subreads in self._iterSubreads(self._zmwTasks()):
+            self._seedZmw(zmw)
+            # subsample_count=0 summarizes the MSA columns without gathering any tensors
             tensor_list = ConsensusTensorList(subreads,
                                               ref=self.ref,
                                               context_width=self.tensors_context_width,
-                                              collection_mode=self.tensors_collection_mode,
-                                              subsample_count=self.tensors_per_poa)
-            tensor_list = self.rescaleTensors(tensor_list)
-            consensus_tensor_lists[zmw] = tensor_list
+                                              subsample_count=0,
+                                              tensor_objects=False,
+                                              alignment_mode=self.poa_alignment_mode,
+                                              band_width=self.poa_band_width,
+                                              cache=self.poa_cache,
+                                              tensor_dtype=self.tensors_dtype,
+                                              feature_dtype=self.poa_feature_dtype,
+                                              release_poa=True)
+            self.rescaleTensors(tensor_list)
+            loci = tensor_list.fullWindowLoci()
+            reservoir.offer(zmw, tensor_list.windows, loci, tensor_list.labelsAt(loci))
+            del tensor_list
+            if stop_when_full and reservoir.isFull():
+                log.info('Reservoir full after ZMW ' + str(zmw))
+                break
 
-        return consensus_tensor_lists
+        return reservoir
+
+    def _zmwTasks(self):
+        """
+        Pick the subreads of each selected ZMW from the pbi
+
+        :return: list of (zmw, subread pbi rows)
+        """
+        tasks = []
+        for zmw in self.zmws:
+            subreads_pbi = self.pbi.iloc[self.zmw_index.rows(zmw)]
+            subreads_pbi = subreads_pbi[subreads_pbi['contextFlag'] == 3]  # make sure adapters flank
+            self._seedZmw(zmw)
+            subread_indices = self.filterSubreads(subreads_pbi)
+            tasks.append((zmw, list(subread_indices)))
 
+        return tasks
+
+    def _poolTensors(self, tasks):
+        """
+        Spread ZMW tasks across a process pool in batches. Results come back
+        in task order regardless of which worker finishes first. At most two
+        batches per worker are in flight, so results don't pile up when the
+        consumer is slower than the pool.
+
+        :return: generator of (zmw, tensors, labels, loci)
+        """
+        batches = [tasks[i:i + self.zmws_per_batch]
+                   for i in range(0, len(tasks), self.zmws_per_batch)]
+        max_in_flight = 2 * self.n_workers
+        pool = multiprocessing.Pool(self.n_workers,
+                                    initializer=_initTensorWorker,
+                                    initargs=(self._workerConfig(), ))
+        try:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(pool.apply_async(_tensorWorkerBatch, (batch, )))
+                if len(pending) >= max_in_flight:
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        finally:
+            pool.terminate()
+
+    def screenZMWs(self):
+        """
+        Summarize the adapter-flanked subreads of every ZMW from the pbi alone,
+        before any BAM record is decoded. Everything is reduced per ZMW with the
+        group index, with no per-ZMW Python loop.
+
+        :return: DataFrame indexed by holeNumber, with columns n_subreads,
+                 mean_length, length_cv (std / mean of qEnd - qStart) and
+                 mean_read_qual. ZMWs without flanked subreads have NaN stats.
+        """
+        flanked = self.pbi['contextFlag'].values == 3  # adapters seen on both sides
+        lengths = (self.pbi['qEnd'].values - self.pbi['qStart'].values).astype(float)
+        counts = self.zmw_index.countWhere(flanked).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_lengths = self.zmw_index.sumWhere(lengths, flanked) / counts
+            mean_squares = self.zmw_index.sumWhere(lengths ** 2, flanked) / counts
+            stds = np.sqrt(np.maximum(mean_squares - mean_lengths ** 2, 0.))
+            length_cvs = stds / mean_lengths
+            mean_read_quals = self.zmw_index.sumWhere(self.pbi['readQual'].values, flanked) / counts
+
+        return pd.DataFrame({'n_subreads': counts.astype(int),
+                             'mean_length': mean_lengths,
+                             'length_cv': length_cvs,
+                             'mean_read_qual': mean_read_quals},
+                            index=pd.Index(self.zmw_index.keys, name='holeNumber'),
+                            columns=['n_subreads', 'mean_length', 'length_cv', 'mean_read_qual'])
 
     def selectZMWs(self):
         """
         Select ZMWs to grab list of consensus tensors from. Enforce that included
         subreads must have flanking adapters and that there are at least the specified
-        number of subreads per ZMW.
+        number of subreads per ZMW. ZMWs whose subread lengths vary more than
+        max_length_cv, or whose mean read quality is below min_read_qual, are
+        rejected from the pbi screen, see screenZMWs.
+
+        'random' selection draws n_zmws_sample of the remaining ZMWs at random.
+        'ranked' selection takes the n_zmws_sample ZMWs with the most consistent
+        subread lengths, breaking ties by read quality.
 
         :return: list of ZMWs
         """
-        pbi = self.pbi[self.pbi['contextFlag'] == 3]  # make sure adapters seen on both sides
-        gb = pbi.groupby(by=['holeNumber'])
-        group_sizes = gb.size()
-        zmws = group_sizes[group_sizes > self.min_coverage_depth].keys()
-        zmws = np.random.choice(np.array(zmws), self.n_zmws_sample)
-        return zmws
+        screen = self.screenZMWs()
+        keep = screen['n_subreads'].values > self.min_coverage_depth
+        if self.max_length_cv is not None:
+            keep &= screen['length_cv'].values <= self.max_length_cv
+        if self.min_read_qual is not None:
+            keep &= screen['mean_read_qual'].values >= self.min_read_qual
+        screen = screen[keep]
+        log.info(str(len(screen)) + ' of ' + str(len(keep)) + ' ZMWs pass the pbi screen')
+
+        zmws = screen.index.values
+        if self.n_zmws_sample is None:
+            return zmws
+        if self.zmw_selection == 'ranked':
+            order = np.lexsort((-screen['mean_read_qual'].values, screen['length_cv'].values))
+            return zmws[order[:self.n_zmws_sample]]
+        # without replacement, so no ZMW is built, or offered to a reservoir, twice
+        return np.random.choice(zmws, min(self.n_zmws_sample, len(zmws)), replace=False)
+
+    def _check_zmw_selection(self):
+        """
+        Make sure ZMW selection is either 'random' or 'ranked'
+        """
+        if self.zmw_selection not in ['random', 'ranked']:
+            raise ValueError("ZMW selection must be either 'random' or 'ranked'. "
+                             "No other options are currently supported.")
+
+    def _check_kinetics_rescale_mode(self):
+        """
+        Make sure kinetics rescale mode is either 'mean' or 'zscore', before
+        any ZMW is aligned
+        """
+        if self.kinetics_rescale_mode not in ['mean', 'zscore']:
+            raise ValueError("Kinetics rescale mode must be either 'mean' or 'zscore'. "
+                             "No other options are currently supported.")
+
+
+def kineticsScales(kinetics_summary, base_order='-ATGC'):
+    """
+    Align by-base kinetics to the row order of the consensus tensors.
+    Deleted bases carry no kinetics, so the '-' row gets a mean and std of 1,
+    which leaves its (zero) cumulative PW and IPD at zero.
+
+    :param kinetics_summary: output of QuickKinetics kinetics.summarizeKinetics()
+    :param base_order: tensor row order
+    :return: dict of 'mean' and 'std' arrays of shape (5, 2), columns (PW, IPD),
+             matching the layer order of the tensors
+    """
+    k = kinetics_summary.reindex(list(base_order))
+    scales = {}
+    for stat in ['mean', 'std']:
+        values = k[['PW_' + stat, 'IPD_' + stat]].values.astype(float)
+        values[base_order.index('-')] = 1.
+        scales[stat] = values
+
+    return scales
+
+
+def rescaleTensorArray(tensors, scales, mode='mean', depth=None):
+    """
+    Rescale the PW and IPD layers of stacked consensus tensors in place,
+    with a single broadcasted operation over every tensor.
+
+    'mean' divides each cumulative PW and IPD by the mean of its base. This
+    weights the kinetics in terms of coverage.
+
+    'zscore' compares each cumulative sum with the sum expected from the
+    number of reads n calling that base: (sum - n * mean) / (std * sqrt(n)).
+    n is recovered from the fraction layer and the MSA depth. Cells without
+    reads are 0.
+
+    :param tensors: (..., 5, width, 3) array, e.g. ConsensusTensorList.tensors
+    :param scales: output of kineticsScales
+    :param mode: 'mean' or 'zscore'
+    :param depth: number of reads in the MSA. Required for 'zscore'.
+    :return: tensors
+    """
+    means = scales['mean'][:, np.newaxis, :]  # (5, 1, 2) broadcasts over (..., 5, width, 2)
+    if mode == 'mean':
+        tensors[..., 1:] /= means
+    elif mode == 'zscore':
+        if depth is None:
+            raise ValueError("MSA depth is required to z-score tensors.")
+        counts = np.rint(tensors[..., 0] * depth)[..., np.newaxis]
+        stds = scales['std'][:, np.newaxis, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            zscores = (tensors[..., 1:] - counts * means) / (stds * np.sqrt(counts))
+        tensors[..., 1:] = np.where(counts > 0, zscores, 0.)
+    else:
+        raise ValueError("Kinetics rescale mode must be either 'mean' or 'zscore'.")
+
+    return tensors
+
+
+def prefetchSubreads(sset, tasks, prefetch=4):
+    """
+    Decode the subreads of upcoming ZMWs in a background thread, so BAM
+    reads overlap with the POA of the current ZMW. Each ZMW's records are
+    read in file-offset order, and the thread stays at most prefetch ZMWs
+    ahead of the consumer.
+
+    :param sset: SubreadSet handle. Only the background thread reads from
+                 it until the generator is exhausted or closed; closing waits
+                 for the ZMW being read, so the caller can use the handle
+                 again once close() returns.
+    :param tasks: list of (zmw, subread pbi rows)
+    :param prefetch: bound on the number of decoded ZMWs waiting in the queue
+    :return: generator of (zmw, subread pbi rows, subreads), in task order,
+             with subreads in the order of their pbi rows
+    """
+    offsets = np.asarray(sset.index['fileOffset'])
+
+    def fetch():
+        for zmw, subread_indices in tasks:
+            rows = np.asarray(subread_indices, dtype=int)
+            order = np.argsort(offsets[rows], kind='mergesort')
+            subreads = [None] * len(rows)
+            for position, subread in zip(order, sset[list(rows[order])]):
+                subreads[position] = subread
+            yield zmw, subread_indices, subreads
+
+    return cts.iterInBackground(fetch(), prefetch)
+
+
+def _initTensorWorker(config):
+    """
+    Pool initializer. Each worker process rebuilds a builder from the
+    config, without selecting ZMWs, and opens its own SubreadSet handle.
+    Without a run seed, forked workers would share the parent's random
+    state and draw the same subsamples, so each is reseeded from the OS.
+
+    :param config: output of SubreadSetCircularConsensusTensors._workerConfig
+    """
+    global _worker_builder
+    if config['seed'] is None:
+        np.random.seed()
+    builder = SubreadSetCircularConsensusTensors.__new__(SubreadSetCircularConsensusTensors)
+    builder.__dict__.update(config)
+    builder.sset = SubreadSet(config['sset_path'])
+    _worker_builder = builder
+
+
+def _tensorWorkerBatch(tasks):
+    """
+    Build the tensors of a batch of ZMWs in a pool worker. Only the tensor
+    and label arrays are returned, never the POA graphs.
+
+    :param tasks: list of (zmw, subread pbi rows)
+    :return: list of (zmw, tensors, labels, loci)
+    """
+    return list(_worker_builder._serialTensors(tasks))
 
 
 class ConsensusTensorList(poa.PoaWithFeatures):
@@ -167,7 +688,14 @@ class ConsensusTensorList(poa.PoaWithFeatures):
                        ref=None,
                        context_width=0,
                        collection_mode='standard',
-                       subsample_count=None):
+                       subsample_count=None,
+                       tensor_objects=True,
+                       alignment_mode='full',
+                       band_width=None,
+                       cache=None,
+                       tensor_dtype=float,
+                       feature_dtype=int,
+                       release_poa=False):
         """
         Initialize PoaConsensusTensorList object. Each argument has default values.
         Defaults to no contexts, standard collection, and no subsampling.
@@ -179,14 +707,49 @@ class ConsensusTensorList(poa.PoaWithFeatures):
         :param subsample_count: returns a particular number of randomly-selected
                                 ConsensusTensor objects. If more samples are requested than
                                 exist, returns max possible number.
+        :param tensor_objects: if True, consensus_tensor_list holds a ConsensusTensor
+                               view for each row of the dense tensors array. If False,
+                               only the dense tensors and labels arrays are kept.
+        :param alignment_mode: 'full', 'banded' or 'anchored' POA alignment, see POA
+        :param band_width: band half-width of 'banded' alignment. None adapts it to
+                           the observed indel rate.
+        :param cache: PoaCache to load the MSA from, or store it in, see PoaWithFeatures
+        :param tensor_dtype: dtype of the tensors array, e.g. np.float32 to halve its size
+        :param feature_dtype: dtype of the feature vector, e.g. np.uint16, see PoaWithFeatures
+        :param release_poa: if True, drop the POA graph, MSA strings and subreads once
+                            the tensors are built, see PoaWithFeatures.releasePoa
         """
         poa.PoaWithFeatures.__init__(self, subreads,
-                                           ref)
+                                           ref,
+                                           alignment_mode=alignment_mode,
+                                           band_width=band_width,
+                                           cache=cache,
+                                           feature_dtype=feature_dtype)
         self.context_width = context_width
         self.collection_mode = collection_mode
         self._check_collection_mode()
+        self._requested_subsample_count = subsample_count
         self.subsample_count = self._subsample_count(subsample_count)
+        self.tensor_objects = tensor_objects
+        self.tensor_dtype = np.dtype(tensor_dtype)
         self.consensus_tensor_list = self.makeConsensusTensors()
+        if release_poa:
+            self.releasePoa()
+
+    def addSubreads(self, subreads):
+        """
+        Add subreads to the existing POA graph, see PoaWithFeatures.addSubreads,
+        and rebuild the tensors from the extended MSA.
+        """
+        poa.PoaWithFeatures.addSubreads(self, subreads)
+        self.subsample_count = self._subsample_count(self._requested_subsample_count)
+        self.consensus_tensor_list = self.makeConsensusTensors()
+
+    def depth(self):
+        """
+        Number of subreads in the MSA
+        """
+        return self.feature_vector[1].shape[0]
 
     def _subsample_count(self, subsample_count):
         """
@@ -219,20 +782,19 @@ class ConsensusTensorList(poa.PoaWithFeatures):
         # populated
         start = self.context_width  # inclusive
         end = len(self.PluralityConsensus[1]) - self.context_width  # inclusive
-        seq = np.array(list(self.PluralityConsensus[1][start:end]))
+        seq = self.consensus_codes[start:end]
 
         # equal-state mode does its best to balance the proportion
         # of each class. May be useful for training classifiers
         if self.collection_mode == 'equal-state':
             if self.subsample_count < (end - start):
-                n = self.subsample_count / 5  # number of tensors to grab of each type
+                n = self.subsample_count // 5  # number of tensors to grab of each type
             else:
-                n = (end - start) / 5
-            tensor_types = ['A', 'C', 'G', 'T', '-']
+                n = (end - start) // 5
             loci = np.zeros((n*5, ), dtype=int)
             loci_ix = 0
-            for type in tensor_types:
-                ixs = np.flatnonzero(seq == type)
+            for type in se.TENSOR_TYPES:
+                ixs = np.flatnonzero(seq == se.BASE_ORDER.index(type)) + start  # seq starts at MSA column start
                 if ixs.size == 0:
                     continue
                 if n > len(ixs):
@@ -261,25 +823,157 @@ class ConsensusTensorList(poa.PoaWithFeatures):
         list of ConsensusTensors
 
         subsample_count and collection_mode are invoked first, to return the indices
-        of the bases which should have their tensors recorded.
+        of the bases which should have their tensors recorded. The MSA columns are
+        summarized once into column_summary, and the tensor of each locus is its
+        context window, a read-only strided view into the summary. Overlapping
+        windows share memory, so the summary and the ConsensusTensor objects
+        holding those views cost the same at any context width. The dense
+        (n_loci, 5, width, 3) tensors array is a copy gathered from the windows,
+        and its size still grows with the context width.
         :return:
         """
         loci = self._get_tensor_loci()
-        if self.refMSA is not None:
-            labels = np.array(list(self.refMSA[1]))[loci]
-        else:
-            labels = np.array(list(self.PluralityConsensus[1]))[loci]
+        labels = self.labelsAt(loci)
+        self.loci = loci
+        self.labels = labels
+        self.column_summary = buildColumnSummary(self.feature_vector[1], dtype=self.tensor_dtype)
+        self.windows = contextWindows(self.column_summary, self.context_width)
+        self.tensors = self.windows[loci - self.context_width]
+        if not self.tensor_objects:
+            return None
+
         tensors = np.empty((len(loci), ), dtype=object)
-        for index, locus in enumerate(loci):
-            ixs = np.arange(locus - self.context_width,
-                            locus + self.context_width + 1)
-            data = self.feature_vector[1][:, ixs, :]
-            label = labels[index]
-            tensors[index] = ConsensusTensor(data=data, label=label)
+        for index, (locus, label) in enumerate(zip(loci, labels)):
+            tensors[index] = ConsensusTensor(tensor=self.windows[locus - self.context_width],
+                                             label=label)
 
         return tensors
 
-class ConsensusTensor:
+    def labelsAt(self, loci):
+        """
+        Labels of MSA columns, from the reference row if there is one, else
+        from the plurality consensus
+        """
+        if self.refMSA is not None:
+            return se.labelsAt(self.refMSA[1], loci)
+        return se.labelsAt(self.PluralityConsensus[1], loci)
+
+    def fullWindowLoci(self):
+        """
+        Every MSA column with a full context window
+        """
+        return np.arange(self.context_width,
+                         len(self.PluralityConsensus[1]) - self.context_width)
+
+    def rescaleKinetics(self, scales, mode='mean'):
+        """
+        Rescale the PW and IPD layers of the column summary in place, see
+        rescaleTensorArray. Each column is rescaled once however many windows
+        overlap it, the ConsensusTensor views follow, and the dense tensors
+        array is gathered again. The windows themselves are read-only.
+
+        :param scales: output of kineticsScales
+        :param mode: 'mean' or 'zscore'
+        """
+        rescaleTensorArray(self.column_summary, scales, mode=mode, depth=self.depth())
+        self.tensors = self.windows[self.loci - self.context_width]
+
+
+def coverageSweep(subreads, min_depth=3, **kwargs):
+    """
+    Grow one ConsensusTensorList a subread at a time, instead of redoing the
+    POA for every coverage depth. The first min_depth subreads seed the
+    graph, and each following subread is added with addSubreads.
+
+    The same ConsensusTensorList is yielded at every depth, updated in place.
+    Its tensors and labels arrays are replaced, not overwritten, on each step,
+    so references kept from earlier depths stay valid.
+
+    :param subreads: subreads of one ZMW, added in the order given
+    :param min_depth: depth of the first step
+    :param kwargs: passed on to ConsensusTensorList
+    :return: generator of (depth, ConsensusTensorList)
+    """
+    subreads = list(subreads)
+    if len(subreads) < min_depth:
+        return
+    tensor_list = ConsensusTensorList(subreads[:min_depth], **kwargs)
+    yield tensor_list.depth(), tensor_list
+    for subread in subreads[min_depth:]:
+        tensor_list.addSubreads([subread])
+        yield tensor_list.depth(), tensor_list
+
+
+def buildColumnSummary(feature_vector, dtype=float):
+    """
+    Summarize every MSA column of a feature vector once: the fraction of
+    reads calling each state, and the cumulative PW and IPD of those reads.
+    Each (state, column) cell is assigned a flat bin, and all reads are
+    reduced with bincount in one go.
+
+    :param feature_vector: (n_reads, msa_length, 3) array from PoaWithFeatures
+    :param dtype: float dtype of the output
+    :return: (5, msa_length, 3) array of dtype, laid out like a ConsensusTensor
+             spanning the whole MSA
+    """
+    nrows = 5  # number of states {'-', 'A', 'T', 'G', 'C'}
+    nreads, ncols = feature_vector.shape[:2]
+    nbins = nrows * ncols
+    summary = np.zeros((nrows, ncols, 3), dtype=dtype)
+    if nreads == 0:
+        return summary
+
+    bins = (feature_vector[:, :, 0].astype(int) * ncols + np.arange(ncols)).ravel()
+    counts = np.bincount(bins, minlength=nbins)
+    summary[:, :, 0] = np.divide(counts, nreads, dtype=float).reshape(nrows, ncols)
+    for layer in (1, 2):
+        sums = np.bincount(bins, weights=feature_vector[:, :, layer].ravel(), minlength=nbins)
+        summary[:, :, layer] = sums.reshape(nrows, ncols)
+
+    return summary
+
+
+def contextWindows(column_summary, context_width):
+    """
+    View every full context window of a column summary, without copying.
+    Window i is centered on MSA column i + context_width, i.e. it is the
+    consensus tensor of that column. Windows overlap in memory, so they are
+    read-only: write to the column summary instead, which updates every
+    window covering the written columns. Indexing the windows with an
+    array of loci returns a writable copy.
+
+    :param column_summary: (5, msa_length, 3) output of buildColumnSummary
+    :param context_width: see definition in ConsensusTensor class docstring
+    :return: (msa_length - 2 * context_width, 5, 1 + 2 * context_width, 3) read-only
+             strided view
+    """
+    nrows, ncols, nlayers = column_summary.shape
+    width = 1 + 2 * context_width
+    row_stride, col_stride, layer_stride = column_summary.strides
+    return np.lib.stride_tricks.as_strided(column_summary,
+                                           shape=(max(ncols - width + 1, 0), nrows, width, nlayers),
+                                           strides=(col_stride, row_stride, col_stride, layer_stride),
+                                           writeable=False)
+
+
+def buildConsensusTensors(feature_vector, loci, context_width, dtype=float):
+    """
+    Build the consensus tensors for every requested locus of a
+    feature vector at once, by gathering their windows from the
+    column summary.
+
+    :param feature_vector: (n_reads, msa_length, 3) array from PoaWithFeatures
+    :param loci: MSA column indices at the center of each tensor. Must be at least
+                 context_width columns away from either edge of the MSA.
+    :param context_width: see definition in ConsensusTensor class docstring
+    :param dtype: float dtype of the output
+    :return: (n_loci, 5, 1 + 2 * context_width, 3) array of dtype
+    """
+    windows = contextWindows(buildColumnSummary(feature_vector, dtype), context_width)
+    return windows[np.asarray(loci, dtype=int) - context_width]
+
+
+class ConsensusTensor(object):
     """
     Class defining tensor summary data
     objects for doing consensus calling
@@ -316,13 +1010,23 @@ class ConsensusTensor:
 
     The cumulative durations (IPD and PW) are z-scored according to by-base
     kinetic distributions
+
+    Instances only carry the tensor and label (__slots__, no __dict__), as
+    ConsensusTensorList may hold one per MSA column.
     """
-    def __init__(self, data,
-                       label):
+    __slots__ = ('tensor', 'label')
+
+    def __init__(self, data=None,
+                       label=None,
+                       tensor=None):
         """
-        Initialize ConsensusTensor object
+        Initialize ConsensusTensor object. Either populate the tensor from the
+        (n_reads, 1 + 2 * context_width, 3) feature data, or wrap an already
+        built tensor (e.g. a row of ConsensusTensorList.tensors) without copying.
         """
-        self.tensor = self._populateTensor(data)  # np.zeros((5, 1 + 2 * context_width, 3))
+        if tensor is None:
+            tensor = self._populateTensor(data)  # np.zeros((5, 1 + 2 * context_width, 3))
+        self.tensor = tensor
         self.label = label
 
     def _populateTensor(self, data):
@@ -330,16 +1034,5 @@ class ConsensusTensor:
         Use the data to populate and return the consensus tensor
         :return:
         """
-        nrows = 5  # number of states {'-', 'A', 'T', 'G', 'C'}
-        ncols = data.shape[1]  # 1 + 2 * context_width
-        nlayers = data.shape[2]  # number of features (fraction, IPD, PW)
-        tensor = np.zeros((nrows, ncols, nlayers), dtype=float)
-        for col_index, col in enumerate(data[:, :, 0].T):
-            bases, indices, counts = np.unique(col, return_inverse=True, return_counts=True)
-            tensor[bases, col_index, 0] = np.divide(counts, np.sum(counts), dtype=float)
-            for base in bases:
-                row_indices = np.flatnonzero(data[:, col_index, 0] == base)
-                tensor[base, col_index, 1] = np.sum(data[row_indices, col_index, 1])
-                tensor[base, col_index, 2] = np.sum(data[row_indices, col_index, 2])
-
-        return tensor
\ No newline at end of file
+        context_width = data.shape[1] // 2  # ncols is 1 + 2 * context_width
+        return buildConsensusTensors(data, [context_width], context_width)[0]
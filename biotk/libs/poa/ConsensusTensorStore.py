@@ -0,0 +1,424 @@
+import SequenceEncoding as se
+import os
+import json
+import tempfile
+import threading
+import Queue
+import numpy as np
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+
+DATASET_FILE = 'dataset.json'
+MANIFEST_FILE = 'manifest.tsv'
+MANIFEST_COLUMNS = ['zmw', 'shard', 'offset', 'count']
+LABEL_DTYPE = 'S1'
+
+
+def shardPath(output_dir, name, shard):
+    """
+    Path of a shard file, e.g. tensors_00003.npy
+    """
+    return os.path.join(output_dir, '%s_%05d.npy' % (name, shard))
+
+
+def iterInBackground(items, prefetch):
+    """
+    Draw items from an iterable in a background thread, staying at most
+    prefetch items ahead of the consumer. An exception raised while drawing
+    is raised again in the consumer. Once the consumer stops iterating, the
+    thread draws no further item, and closing the generator waits for the
+    item being drawn, so the iterable's resources are free again when it
+    returns.
+
+    :param items: iterable, only consumed by the background thread
+    :param prefetch: bound on the number of items waiting in the queue
+    :return: generator of the items, in order
+    """
+    queue = Queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def produce():
+        iterator = iter(items)
+        try:
+            while not stop.is_set():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    put(done)
+                    return
+                put(item)
+        except Exception as error:
+            put(error)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def readManifest(output_dir):
+    """
+    Read the per-ZMW manifest of a tensor dataset. A trailing line left
+    incomplete by an interrupted run is ignored, even if it happens to
+    parse: only lines ending in a newline are complete.
+
+    :return: recarray with zmw, shard, offset and count columns
+    """
+    entries = []
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest:
+            # the last element is '' if the file ends in a newline, and the
+            # unterminated last line otherwise
+            lines = manifest.read().split('\n')[:-1]
+            for line in lines[1:]:
+                fields = line.split('\t')
+                if len(fields) != len(MANIFEST_COLUMNS) or '' in fields:
+                    continue
+                entries.append(tuple(int(field) for field in fields))
+
+    return np.array(entries, dtype=[(column, int) for column in MANIFEST_COLUMNS])
+
+
+class ConsensusTensorShardWriter:
+    """
+    Append consensus tensors and their labels to fixed-size .npy shards.
+
+    Each shard i holds shard_size rows in four files, all of which can be
+    opened with np.load(mmap_mode='r'):
+        tensors_i.npy   (shard_size, 5, 1 + 2 * context_width, 3) tensors
+        labels_i.npy    (shard_size, ) label of each tensor
+        zmws_i.npy      (shard_size, ) holeNumber of each tensor
+        loci_i.npy      (shard_size, ) MSA column of each tensor (-1 if unknown)
+
+    dataset.json records the shard size, tensor shape and dtype, and
+    manifest.tsv gets one line per ZMW (zmw, shard, offset, count) once all
+    of its tensors are flushed to disk. Rows past the last manifest line are
+    not part of the dataset, so opening an existing output_dir resumes
+    right after the last completed ZMW.
+    """
+    def __init__(self, output_dir,
+                       shard_size=100000,
+                       dtype=np.float32):
+        """
+        :param output_dir: directory to write shards to. Created if missing, resumed
+                           if it already holds a dataset.
+        :param shard_size: number of tensors per shard
+        :param dtype: dtype of the stored tensors
+        """
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self.tensor_shape = None
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        self._loadDataset()
+
+        manifest = readManifest(self.output_dir)
+        self.completed_zmws = set(manifest['zmw'].tolist())
+        if len(manifest) > 0:
+            last = manifest[-1]
+            self.count = last['shard'] * self.shard_size + last['offset'] + last['count']
+        else:
+            self.count = 0
+        self._truncateManifest(manifest)
+        self._shards = {}
+
+    def _loadDataset(self):
+        """
+        Load the dataset description of an existing output_dir, and make sure
+        it is compatible with the requested shard size and dtype
+        """
+        dataset_path = os.path.join(self.output_dir, DATASET_FILE)
+        if not os.path.exists(dataset_path):
+            return
+        with open(dataset_path, 'r') as dataset_file:
+            dataset = json.load(dataset_file)
+        if (dataset['shard_size'] != self.shard_size or
+            np.dtype(str(dataset['dtype'])) != self.dtype):
+            raise ValueError('Existing dataset in ' + self.output_dir + ' has shard_size ' +
+                             str(dataset['shard_size']) + ' and dtype ' + str(dataset['dtype']) +
+                             '. Cannot resume with different values.')
+        self.tensor_shape = tuple(dataset['tensor_shape'])
+        log.info('Resuming tensor dataset in ' + self.output_dir)
+
+    def _writeDataset(self):
+        """
+        Record shard size, tensor shape and dtype
+        """
+        dataset = {'shard_size': self.shard_size,
+                   'tensor_shape': list(self.tensor_shape),
+                   'dtype': self.dtype.str,
+                   'label_dtype': LABEL_DTYPE}
+        with open(os.path.join(self.output_dir, DATASET_FILE), 'w') as dataset_file:
+            json.dump(dataset, dataset_file)
+
+    def _truncateManifest(self, manifest):
+        """
+        Rewrite the manifest with only its complete lines, so an interrupted
+        append doesn't corrupt the lines written after resuming. Nothing is
+        rewritten if the manifest is already complete, and a rewrite goes
+        through a temporary file renamed over the manifest, so a crash while
+        rewriting can't lose the resume state.
+        """
+        manifest_path = os.path.join(self.output_dir, MANIFEST_FILE)
+        lines = ['\t'.join(MANIFEST_COLUMNS)]
+        lines.extend('\t'.join(str(field) for field in entry) for entry in manifest)
+        text = '\n'.join(lines) + '\n'
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                if manifest_file.read() == text:
+                    return
+
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.output_dir)
+        with os.fdopen(handle, 'w') as tmp:
+            tmp.write(text)
+        os.rename(tmp_path, manifest_path)
+
+    def _shard(self, shard):
+        """
+        Return the memory-mapped arrays of a shard, creating its files if needed
+        """
+        if shard in self._shards:
+            return self._shards[shard]
+
+        # only the most recent shard is ever written to
+        self._flush()
+        self._shards = {}
+        shapes = {'tensors': ((self.shard_size, ) + self.tensor_shape, self.dtype),
+                  'labels': ((self.shard_size, ), LABEL_DTYPE),
+                  'zmws': ((self.shard_size, ), np.int64),
+                  'loci': ((self.shard_size, ), np.int64)}
+        arrays = {}
+        for name, (shape, dtype) in shapes.items():
+            path = shardPath(self.output_dir, name, shard)
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode='r+')
+            else:
+                arrays[name] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        self._shards[shard] = arrays
+        return arrays
+
+    def _flush(self):
+        for arrays in self._shards.values():
+            for array in arrays.values():
+                array.flush()
+
+    def isComplete(self, zmw):
+        """
+        Whether all tensors of zmw are already on disk
+        """
+        return zmw in self.completed_zmws
+
+    def write(self, zmw, tensors, labels, loci=None):
+        """
+        Append the tensors of a ZMW. ZMWs already in the manifest are skipped.
+
+        :param zmw: holeNumber
+        :param tensors: (n, 5, 1 + 2 * context_width, 3) array
+        :param labels: (n, ) labels
+        :param loci: (n, ) MSA columns of the tensors. None stores -1.
+        """
+        zmw = int(zmw)
+        if self.isComplete(zmw):
+            return
+        if self.tensor_shape is None:
+            self.tensor_shape = tuple(tensors.shape[1:])
+            self._writeDataset()
+        elif tuple(tensors.shape[1:]) != self.tensor_shape:
+            raise ValueError('Tensor shape ' + str(tensors.shape[1:]) + ' does not match the '
+                             'dataset tensor shape ' + str(self.tensor_shape) + '.')
+        if loci is None:
+            loci = np.full((len(tensors), ), -1, dtype=np.int64)
+        labels = np.asarray(labels).astype(LABEL_DTYPE)
+
+        start = self.count
+        written = 0
+        while written < len(tensors):
+            shard, offset = divmod(start + written, self.shard_size)
+            n = min(len(tensors) - written, self.shard_size - offset)
+            arrays = self._shard(shard)
+            arrays['tensors'][offset:offset + n] = tensors[written:written + n]
+            arrays['labels'][offset:offset + n] = labels[written:written + n]
+            arrays['zmws'][offset:offset + n] = zmw
+            arrays['loci'][offset:offset + n] = loci[written:written + n]
+            written += n
+        self._flush()
+
+        # the manifest line marks the ZMW as complete, so write it last
+        shard, offset = divmod(start, self.shard_size)
+        with open(os.path.join(self.output_dir, MANIFEST_FILE), 'a') as manifest_file:
+            manifest_file.write('\t'.join(str(field) for field in
+                                          [zmw, shard, offset, len(tensors)]) + '\n')
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        self.count = start + len(tensors)
+        self.completed_zmws.add(zmw)
+
+    def close(self):
+        """
+        Flush and release the open shards
+        """
+        self._flush()
+        self._shards = {}
+
+
+class ConsensusTensorShardReader:
+    """
+    Serve minibatches from a tensor dataset written by
+    ConsensusTensorShardWriter, without loading it into memory.
+
+    Tensor shards are opened as np.memmap and each batch is gathered shard
+    by shard straight into a freshly allocated batch array, in sorted row
+    order within a shard. Only the labels are held in memory, for
+    class balancing. A background thread prepares the next batches while
+    the current one is being used.
+
+    Collection modes mirror ConsensusTensorList:
+        'standard'      shuffled rows, each row once per epoch
+        'equal-state'   each batch holds an equal number of {A, C, G, T, -}
+                        tensors. Rare classes are cycled through in a new
+                        random order each time they run out, so no
+                        tensor repeats within a pass over its class.
+    """
+    def __init__(self, output_dir,
+                       batch_size=256,
+                       collection_mode='standard',
+                       prefetch=2,
+                       seed=None):
+        """
+        :param output_dir: directory written by ConsensusTensorShardWriter
+        :param batch_size: number of tensors per batch
+        :param collection_mode: 'standard' or 'equal-state'
+        :param prefetch: number of batches the background thread prepares ahead.
+                         0 prepares batches in the calling thread.
+        :param seed: seed of the reader's own random state
+        """
+        if (collection_mode != 'standard') and (collection_mode != 'equal-state'):
+            raise ValueError("Collection mode must be either 'standard' or 'equal-state'. "
+                             "No other options are currently supported.")
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.collection_mode = collection_mode
+        self.prefetch = prefetch
+        self.random_state = np.random.RandomState(seed)
+
+        with open(os.path.join(self.output_dir, DATASET_FILE), 'r') as dataset_file:
+            dataset = json.load(dataset_file)
+        self.shard_size = dataset['shard_size']
+        self.tensor_shape = tuple(dataset['tensor_shape'])
+        self.dtype = np.dtype(str(dataset['dtype']))
+
+        manifest = readManifest(self.output_dir)
+        if len(manifest) > 0:
+            last = manifest[-1]
+            self.count = last['shard'] * self.shard_size + last['offset'] + last['count']
+        else:
+            self.count = 0
+        n_shards = -(-self.count // self.shard_size)
+        self.tensors = [np.load(shardPath(self.output_dir, 'tensors', shard), mmap_mode='r')
+                        for shard in range(n_shards)]
+        labels = [np.load(shardPath(self.output_dir, 'labels', shard), mmap_mode='r')
+                  for shard in range(n_shards)]
+        self.labels = np.concatenate(labels)[:self.count] if labels else np.zeros((0, ), LABEL_DTYPE)
+        self.class_indices = dict((tensor_type, np.flatnonzero(self.labels == tensor_type))
+                                  for tensor_type in np.asarray(se.TENSOR_TYPES, dtype=LABEL_DTYPE))
+        self.class_indices = dict((k, v) for k, v in self.class_indices.items() if v.size > 0)
+
+    def __len__(self):
+        return self.count
+
+    def nBatches(self):
+        """
+        Number of batches in one epoch
+        """
+        return self.count // self.batch_size
+
+    def gather(self, indices):
+        """
+        Gather tensors and labels of dataset rows into a new batch array
+
+        :param indices: dataset row indices
+        :return: (tensors, labels) with rows in sorted index order
+        """
+        indices = np.sort(np.asarray(indices, dtype=int))
+        batch = np.empty((len(indices), ) + self.tensor_shape, dtype=self.dtype)
+        shards = indices // self.shard_size
+        bounds = np.flatnonzero(np.diff(shards)) + 1
+        for start, end in zip(np.concatenate(([0], bounds)),
+                              np.concatenate((bounds, [len(indices)]))):
+            if start == end:
+                continue
+            np.take(self.tensors[shards[start]],
+                    indices[start:end] % self.shard_size,
+                    axis=0,
+                    out=batch[start:end])
+
+        return batch, self.labels[indices]
+
+    def _epochIndices(self):
+        """
+        Row indices of each batch of one epoch
+        """
+        n_batches = self.nBatches()
+        if self.collection_mode == 'standard':
+            order = self.random_state.permutation(self.count)
+            for batch in range(n_batches):
+                yield order[batch * self.batch_size:(batch + 1) * self.batch_size]
+            return
+
+        types = sorted(self.class_indices)
+        if not types:
+            return
+        per_type = np.full((len(types), ), self.batch_size // len(types), dtype=int)
+        per_type[:self.batch_size % len(types)] += 1
+        orders = dict((t, self.random_state.permutation(self.class_indices[t])) for t in types)
+        cursors = dict((t, 0) for t in types)
+        for batch in range(n_batches):
+            indices = []
+            for tensor_type, n in zip(types, per_type):
+                while n > 0:
+                    if cursors[tensor_type] == len(orders[tensor_type]):
+                        orders[tensor_type] = self.random_state.permutation(orders[tensor_type])
+                        cursors[tensor_type] = 0
+                    take = orders[tensor_type][cursors[tensor_type]:cursors[tensor_type] + n]
+                    cursors[tensor_type] += len(take)
+                    n -= len(take)
+                    indices.append(take)
+            yield np.concatenate(indices)
+
+    def iterBatches(self):
+        """
+        Iterate through one epoch of minibatches
+
+        :return: generator of (tensors, labels)
+        """
+        batches = (self.gather(indices) for indices in self._epochIndices())
+        if self.prefetch <= 0:
+            for batch in batches:
+                yield batch
+            return
+
+        for batch in iterInBackground(batches, self.prefetch):
+            yield batch
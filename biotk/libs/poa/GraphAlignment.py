@@ -0,0 +1,383 @@
+import numpy as np
+import bisect
+import KmerOrientation as ko
+import SequenceEncoding as se
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+
+# scores of seqgraphalignment.SeqGraphAlignment
+MATCH_SCORE = 4
+MISMATCH_SCORE = -2
+GAP_SCORE = -4
+
+_NEG = -2 ** 30  # score of cells outside the band
+_DIAG, _UP, _LEFT = 0, 1, 2  # backtrack moves: match/mismatch, node only, sequence only
+
+
+def graphDepths(nodes):
+    """
+    Longest-path depth of each node from the start of the graph. Parallel
+    branches of the graph get similar depths, so depth tracks position
+    along the insert.
+
+    :param nodes: graph nodes in topological order
+    :return: (dict of node ID -> depth, maximum depth)
+    """
+    depths = {}
+    for node in nodes:
+        depths[node.ID] = 1 + max([depths[pred] for pred in node.inEdges] or [0])
+    return depths, max(list(depths.values()) or [0])
+
+
+def adaptiveBandWidth(seq_length, graph_length, indel_rate, min_band_width=32):
+    """
+    Band half-width for aligning a sequence to a graph. The band has to
+    absorb the length difference plus the random drift off the diagonal
+    from indels, which grows with the square root of the number of indels.
+
+    :param indel_rate: expected indels per aligned base
+    """
+    drift = 4 * np.sqrt(indel_rate * seq_length)
+    return int(max(min_band_width, abs(seq_length - graph_length) + drift))
+
+
+class BandedSeqGraphAlignment:
+    """
+    Global alignment of a sequence to a POA graph, with the dynamic
+    programming restricted to a diagonal band.
+
+    Row i of the DP (the i-th node in topological order) is only filled
+    for sequence positions within band_width of the node's expected
+    position, depth * len(sequence) / max depth. The alignment exposes the
+    same stringidxs and nodeidxs as seqgraphalignment.SeqGraphAlignment,
+    so it can be passed to POAGraph.incorporateSeqAlignment.
+
+    If the best path runs along the edge of the band the band was likely
+    too narrow, and overflowed is set. The caller should then fall back
+    to the full DP.
+
+    :param band_width: band half-width. None sizes the band from indel_rate,
+                       see adaptiveBandWidth.
+    :param indel_rate: expected indels per aligned base, used when band_width is None
+    """
+    def __init__(self, sequence, graph,
+                       band_width=None,
+                       indel_rate=0.15,
+                       matchscore=MATCH_SCORE,
+                       mismatchscore=MISMATCH_SCORE,
+                       gapscore=GAP_SCORE):
+        self.sequence = sequence
+        self.graph = graph
+        self.band_width = band_width
+        self.indel_rate = indel_rate
+        self._matchscore = matchscore
+        self._mismatchscore = mismatchscore
+        self._gap = gapscore
+        self.overflowed = False
+        self.score = None
+        self.stringidxs, self.nodeidxs = self.alignStringToGraphBanded()
+
+    def _shifted(self, row, row_lo, lo, width, shift):
+        """
+        Values of a DP row at sequence positions lo - shift ... lo - shift + width - 1,
+        with _NEG outside the row's band
+        """
+        out = np.full((width, ), _NEG, dtype=np.int64)
+        start = max(0, row_lo + shift - lo)
+        end = min(width, row_lo + len(row) + shift - lo)
+        if start < end:
+            out[start:end] = row[start + lo - shift - row_lo:end + lo - shift - row_lo]
+        return out
+
+    def alignStringToGraphBanded(self):
+        """
+        Fill the banded DP and backtrack.
+
+        :return: (sequence index or None, node ID or None) for each aligned column
+        """
+        nodes = list(self.graph.nodeiterator()())
+        seq = se.byteView(self.sequence)
+        m = len(seq)
+        depths, max_depth = graphDepths(nodes)
+        node_rows = dict((node.ID, row) for row, node in enumerate(nodes))
+        if self.band_width is None:
+            self.band_width = adaptiveBandWidth(m, max_depth, self.indel_rate)
+
+        # the start row sits before the graph; a full row of leading insertions
+        start_scores = np.arange(m + 1, dtype=np.int64) * self._gap
+        los, scores, moves, preds = [], [], [], []
+        for node in nodes:
+            center = int(round(depths[node.ID] * m / float(max(max_depth, 1))))
+            lo = max(0, center - self.band_width)
+            hi = min(m, center + self.band_width)
+            width = hi - lo + 1
+
+            j = np.arange(lo, hi + 1)
+            base_scores = np.where(seq[np.maximum(j - 1, 0)] == ord(node.base),
+                                   self._matchscore, self._mismatchscore)
+            best = np.full((width, ), _NEG, dtype=np.int64)
+            move = np.zeros((width, ), dtype=np.int8)
+            pred = np.full((width, ), -1, dtype=np.int32)
+            pred_rows = [node_rows[pred_id] for pred_id in node.inEdges] or [-1]
+            for pred_row in pred_rows:
+                if pred_row == -1:
+                    pred_scores, pred_lo = start_scores, 0
+                else:
+                    pred_scores, pred_lo = scores[pred_row], los[pred_row]
+                diag = self._shifted(pred_scores, pred_lo, lo, width, 1) + base_scores
+                diag[j == 0] = _NEG
+                up = self._shifted(pred_scores, pred_lo, lo, width, 0) + self._gap
+                for candidate, candidate_move in [(diag, _DIAG), (up, _UP)]:
+                    better = candidate > best
+                    best[better] = candidate[better]
+                    move[better] = candidate_move
+                    pred[better] = pred_row
+
+            # insertions run along the row: best[j] = max over k <= j of best[k] + (j - k) * gap
+            offsets = np.arange(width) * self._gap
+            row_scores = np.maximum.accumulate(best - offsets) + offsets
+            move[row_scores > best] = _LEFT
+            los.append(lo)
+            scores.append(row_scores)
+            moves.append(move)
+            preds.append(pred)
+
+        return self._backtrack(nodes, m, los, scores, moves, preds)
+
+    def _backtrack(self, nodes, m, los, scores, moves, preds):
+        """
+        Backtrack from the best terminal node at the end of the sequence
+        """
+        terminal_rows = [row for row, node in enumerate(nodes)
+                         if len(node.outEdges) == 0 and los[row] <= m < los[row] + len(scores[row])]
+        if not terminal_rows:
+            self.overflowed = True
+            return [], []
+        row = max(terminal_rows, key=lambda r: scores[r][m - los[r]])
+        self.score = int(scores[row][m - los[row]])
+
+        stringidxs, nodeidxs = [], []
+        j = m
+        while row != -1:
+            lo = los[row]
+            hi = lo + len(scores[row]) - 1
+            if (j == lo and lo > 0) or (j == hi and hi < m):
+                self.overflowed = True
+            cell = j - lo
+            move = moves[row][cell]
+            if move == _LEFT:
+                stringidxs.append(j - 1)
+                nodeidxs.append(None)
+                j -= 1
+                continue
+            nodeidxs.append(nodes[row].ID)
+            if move == _DIAG:
+                stringidxs.append(j - 1)
+                j -= 1
+            else:
+                stringidxs.append(None)
+            row = preds[row][cell]
+        # leading insertions before the first node
+        while j > 0:
+            stringidxs.append(j - 1)
+            nodeidxs.append(None)
+            j -= 1
+
+        stringidxs.reverse()
+        nodeidxs.reverse()
+        return stringidxs, nodeidxs
+
+    def observedIndelRate(self):
+        """
+        Fraction of alignment columns that are insertions or deletions
+        """
+        if not self.stringidxs:
+            return 0.
+        gaps = sum(1 for i, n in zip(self.stringidxs, self.nodeidxs) if i is None or n is None)
+        return gaps / float(len(self.stringidxs))
+
+
+def globalPairwiseAlignment(seq1, seq2,
+                            matchscore=MATCH_SCORE,
+                            mismatchscore=MISMATCH_SCORE,
+                            gapscore=GAP_SCORE):
+    """
+    Needleman-Wunsch alignment of two byte arrays, one DP row at a time.
+
+    :return: (score, list of (seq1 index or None, seq2 index or None))
+    """
+    n, m = len(seq1), len(seq2)
+    offsets = np.arange(m + 1, dtype=np.int64) * gapscore
+    moves = np.zeros((n + 1, m + 1), dtype=np.int8)
+    moves[0, 1:] = _LEFT
+    row = offsets.copy()
+    for i in range(1, n + 1):
+        diag = np.full((m + 1, ), _NEG, dtype=np.int64)
+        diag[1:] = row[:-1] + np.where(seq2 == seq1[i - 1], matchscore, mismatchscore)
+        up = row + gapscore
+        best = np.maximum(diag, up)
+        move = np.where(diag >= up, _DIAG, _UP).astype(np.int8)
+        row = np.maximum.accumulate(best - offsets) + offsets
+        move[row > best] = _LEFT
+        moves[i] = move
+
+    pairs = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        move = moves[i, j]
+        if move == _DIAG:
+            pairs.append((i - 1, j - 1))
+            i -= 1
+            j -= 1
+        elif move == _UP:
+            pairs.append((i - 1, None))
+            i -= 1
+        else:
+            pairs.append((None, j - 1))
+            j -= 1
+    pairs.reverse()
+    return int(row[m]), pairs
+
+
+def chainAnchors(anchors):
+    """
+    Longest chain of anchors increasing along both sequences
+    (longest increasing subsequence, O(n log n)).
+
+    :param anchors: (n, 2) array of (position in seq1, position in seq2),
+                    sorted by position in seq2 with distinct seq2 positions
+    :return: chained rows of anchors
+    """
+    tails, tail_ixs = [], []
+    parents = np.full((len(anchors), ), -1, dtype=int)
+    for index, position in enumerate(anchors[:, 0]):
+        slot = bisect.bisect_left(tails, position)
+        if slot > 0:
+            parents[index] = tail_ixs[slot - 1]
+        if slot == len(tails):
+            tails.append(position)
+            tail_ixs.append(index)
+        else:
+            tails[slot] = position
+            tail_ixs[slot] = index
+
+    chain = []
+    index = tail_ixs[-1] if tail_ixs else -1
+    while index != -1:
+        chain.append(index)
+        index = parents[index]
+    chain.reverse()
+    return anchors[chain]
+
+
+class AnchoredSeqGraphAlignment:
+    """
+    Seeded alignment of a sequence to a POA graph.
+
+    Exact k-mers that occur once in the sequence and once in the graph's
+    consensus path are chained into co-linear anchors. The anchored bases are
+    matched to their consensus nodes directly, and dynamic programming only
+    runs on the gaps between anchors, against the consensus path. For
+    high-identity subreads the anchors cover most of the read, so the cost is
+    close to linear in read length.
+
+    Only nodes on the consensus path are aligned to. The alignment exposes the
+    same stringidxs and nodeidxs as seqgraphalignment.SeqGraphAlignment, so it
+    can be passed to POAGraph.incorporateSeqAlignment. When anchors cover less
+    than min_anchored_fraction of the sequence, too_few_anchors is set and the
+    caller should fall back to a graph DP.
+    """
+    def __init__(self, sequence, graph,
+                       kmer_size=15,
+                       min_anchored_fraction=0.3,
+                       matchscore=MATCH_SCORE,
+                       mismatchscore=MISMATCH_SCORE,
+                       gapscore=GAP_SCORE):
+        self.sequence = sequence
+        self.graph = graph
+        self.kmer_size = kmer_size
+        self.min_anchored_fraction = min_anchored_fraction
+        self._matchscore = matchscore
+        self._mismatchscore = mismatchscore
+        self._gap = gapscore
+        self.anchored_fraction = 0.
+        self.too_few_anchors = False
+        self.score = None
+        self.stringidxs, self.nodeidxs = self.alignStringToGraphAnchored()
+
+    def _uniqueKmers(self, seq):
+        """
+        Codes and positions of k-mers occurring once in seq
+        """
+        codes, _, positions = ko.kmerCodes(seq, self.kmer_size, return_positions=True)
+        codes, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        return codes[counts == 1], positions[first[counts == 1]]
+
+    def findAnchors(self, path_seq):
+        """
+        Chained, non-overlapping exact matches between the consensus path and
+        the sequence
+
+        :return: list of (consensus position, sequence position, length)
+        """
+        path_codes, path_positions = self._uniqueKmers(path_seq)
+        seq_codes, seq_positions = self._uniqueKmers(self.sequence)
+        _, path_ixs, seq_ixs = np.intersect1d(path_codes, seq_codes,
+                                              assume_unique=True,
+                                              return_indices=True)
+        anchors = np.column_stack((path_positions[path_ixs], seq_positions[seq_ixs]))
+        anchors = chainAnchors(anchors[np.argsort(anchors[:, 1])])
+
+        # merge k-mers on the same diagonal, and trim overlaps between the rest
+        segments = []
+        for path_pos, seq_pos in anchors:
+            length = self.kmer_size
+            if segments:
+                last_path, last_seq, last_length = segments[-1]
+                if path_pos - seq_pos == last_path - last_seq and seq_pos <= last_seq + last_length:
+                    segments[-1] = (last_path, last_seq, seq_pos + length - last_seq)
+                    continue
+                overlap = max(last_path + last_length - path_pos, last_seq + last_length - seq_pos, 0)
+                path_pos, seq_pos, length = path_pos + overlap, seq_pos + overlap, length - overlap
+                if length <= 0:
+                    continue
+            segments.append((path_pos, seq_pos, length))
+        return segments
+
+    def alignStringToGraphAnchored(self):
+        """
+        Anchor, chain, and fill the gaps between anchors
+
+        :return: (sequence index or None, node ID or None) for each aligned column
+        """
+        path, bases, _ = self.graph.consensus()
+        path_seq = se.byteView(''.join(bases))
+        seq = se.byteView(self.sequence)
+        segments = self.findAnchors(''.join(bases))
+        self.anchored_fraction = sum(s[2] for s in segments) / float(max(len(seq), 1))
+        if self.anchored_fraction < self.min_anchored_fraction:
+            self.too_few_anchors = True
+            return [], []
+
+        stringidxs, nodeidxs = [], []
+        score = 0
+        path_end, seq_end = 0, 0
+        for path_pos, seq_pos, length in segments + [(len(path_seq), len(seq), 0)]:
+            gap_score, pairs = globalPairwiseAlignment(path_seq[path_end:path_pos],
+                                                       seq[seq_end:seq_pos],
+                                                       self._matchscore,
+                                                       self._mismatchscore,
+                                                       self._gap)
+            score += gap_score
+            for path_ix, seq_ix in pairs:
+                nodeidxs.append(None if path_ix is None else path[path_end + path_ix])
+                stringidxs.append(None if seq_ix is None else seq_end + seq_ix)
+            nodeidxs.extend(path[path_pos:path_pos + length])
+            stringidxs.extend(range(seq_pos, seq_pos + length))
+            score += length * self._matchscore
+            path_end, seq_end = path_pos + length, seq_pos + length
+
+        self.score = score
+        return stringidxs, nodeidxs
@@ -0,0 +1,81 @@
+import numpy as np
+import SequenceEncoding as se
+
+
+def kmerCodes(seq, k, return_positions=False):
+    """
+    Compute the integer codes of every k-mer in seq, for both strands
+    in a single rolling pass.
+
+    :param seq: nucleotide sequence
+    :param k: k-mer size, at most 32 so codes fit in uint64
+    :param return_positions: also return the start position of each k-mer in seq
+    :return: (forward codes, reverse-complement codes). Element i of the
+             reverse-complement codes is the code of the reverse complement
+             of the i-th forward k-mer. K-mers covering non-ACGT bases are
+             dropped from both.
+    """
+    if k > 32:
+        raise ValueError('k-mer size must be at most 32.')
+    codes = se.TWO_BIT[se.byteView(seq)]
+    nkmers = len(codes) - k + 1
+    if nkmers <= 0:
+        empty = np.zeros((0, ), dtype=np.uint64)
+        if return_positions:
+            return empty, empty, np.zeros((0, ), dtype=int)
+        return empty, empty
+
+    bases = np.minimum(codes, 3).astype(np.uint64)
+    fwd = np.zeros((nkmers, ), dtype=np.uint64)
+    rc = np.zeros((nkmers, ), dtype=np.uint64)
+    for j in range(k):
+        window = bases[j:j + nkmers]
+        fwd = (fwd << np.uint64(2)) | window
+        rc = rc | ((np.uint64(3) - window) << np.uint64(2 * j))
+
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid[k:] - invalid[:nkmers]) == 0
+    if return_positions:
+        return fwd[valid], rc[valid], np.flatnonzero(valid)
+    return fwd[valid], rc[valid]
+
+
+def kmerSketch(seq, k):
+    """
+    Return the sorted, unique forward k-mer codes of seq. Used as the
+    reference side of strandScores.
+    """
+    return np.unique(kmerCodes(seq, k)[0])
+
+
+def strandScores(seq, sketch, k):
+    """
+    Count the distinct k-mers of seq, and of its reverse complement,
+    that are shared with a reference sketch.
+
+    :param seq: query sequence
+    :param sketch: output of kmerSketch for the reference sequence
+    :param k: k-mer size used to build the sketch
+    :return: (forward score, reverse-complement score)
+    """
+    fwd, rc = kmerCodes(seq, k)
+    fwd_score = np.count_nonzero(np.in1d(np.unique(fwd), sketch, assume_unique=True))
+    rc_score = np.count_nonzero(np.in1d(np.unique(rc), sketch, assume_unique=True))
+    return fwd_score, rc_score
+
+
+def callStrand(fwd_score, rc_score, min_ratio=2., min_shared=3):
+    """
+    Decide strand from shared k-mer scores.
+
+    :param min_ratio: winning score must be at least min_ratio times the losing one
+    :param min_shared: winning score must share at least this many k-mers
+    :return: 'forward', 'reverse', or None if the scores are too close to call
+    """
+    best = max(fwd_score, rc_score)
+    worst = min(fwd_score, rc_score)
+    if best < min_shared or best < min_ratio * worst:
+        return None
+    if fwd_score > rc_score:
+        return 'forward'
+    return 'reverse'
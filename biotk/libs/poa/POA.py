@@ -3,39 +3,66 @@ sys.path.append('/pbi/dept/enzymology/Kristofor/repos/poapy') # fix this
 import numpy as np
 import poagraph
 import seqgraphalignment
+import KmerOrientation as ko
+import GraphAlignment as ga
+import SequenceEncoding as se
+import levenshtein_distance as ld
 import logging
 logging.basicConfig()
 log = logging.getLogger(__name__)
 
-try: # try to import ubuntu-compiled ld, then mac, then pure python one (slow)
-    import ubuntu.levenshtein_distance as ld
-    log.info('Running ubuntu-compiled levenshtein code...')
-except ImportError: # ubuntu errored
-    try:
-        import mac.levenshtein_distance as ld
-        log.info('Running mac-compiled levenshtein code...')
-    except ImportError: # mac one errored
-        import levenshtein_distance as ld
-        log.info('Running pure python levenshtein code. Slow!')
-
 
 class POA:
     """
     Generate partial-order alignment from collection of subreads
     """
     def __init__(self, subreads,
-                       ref=None):
+                       ref=None,
+                       orientation_kmer_size=12,
+                       orientation_min_ratio=2.,
+                       alignment_mode='full',
+                       band_width=None,
+                       anchor_kmer_size=15):
         self.subreads = subreads
         # if ref is populated, perform MSA against the
         # reference sequence. Otherwise align against
         # the last subread
         self.reference = ref
+        # strand of each subread is called from k-mers shared with
+        # the root sequence. Calls closer than orientation_min_ratio
+        # fall back to levenshtein distance.
+        self.orientation_kmer_size = orientation_kmer_size
+        self.orientation_min_ratio = orientation_min_ratio
+        # 'full' fills the whole DP of every subread against the graph.
+        # 'banded' restricts it to a band around the diagonal (band_width,
+        # or sized from the indel rate seen so far when None), and falls
+        # back to the full DP when the band overflows.
+        # 'anchored' chains exact anchor_kmer_size-mers shared with the
+        # consensus path and only runs DP between them, falling back to
+        # the full DP when anchors cover too little of the subread.
+        self.alignment_mode = alignment_mode
+        self._check_alignment_mode()
+        self.band_width = band_width
+        self.anchor_kmer_size = anchor_kmer_size
+        self.indel_rate = 0.15  # prior for raw subreads, updated by banded alignments
 
     def generatePoaGraph(self):
         """
         Given list of subreads, generate MSA using POA graphs
         """
         subreads = list(self.subreads)
+        graph = self.seedPoaGraph(subreads)
+        self.incorporateSubreads(graph, subreads)
+        return graph
+
+    def seedPoaGraph(self, subreads):
+        """
+        Start the graph from the reference, or else from the last subread,
+        which is popped from subreads
+
+        :param subreads: list of subreads
+        :return: POAGraph
+        """
         if self.reference:
             # the seeded sequence is the reference
             root_subread = self.reference
@@ -48,29 +75,89 @@ class POA:
             self.root_subread = root_subread
             root_seq = root_subread.read(aligned=False)
             root_label = root_subread.qName
-        graph = poagraph.POAGraph(root_seq, label=root_label)
+        self.root_seq = root_seq
+        self.root_sketch = ko.kmerSketch(root_seq, self.orientation_kmer_size)
+        return poagraph.POAGraph(root_seq, label=root_label)
+
+    def incorporateSubreads(self, graph, subreads):
+        """
+        Align subreads to an existing graph one at a time, and add them to it
+
+        :param graph: POAGraph started by seedPoaGraph
+        :param subreads: list of subreads
+        """
         for subread in subreads:
-            # uses levenshtein distance to determine if sequence should
+            # uses shared k-mers to determine if sequence should
             # be reverse-complemented before being added to the POA MSA
-            subread_seq = self._check_direction(subread.read(aligned=False), root_seq)
+            subread_seq = self._check_direction(subread.read(aligned=False),
+                                                self.root_seq,
+                                                self.root_sketch)
 
             subread_label = subread.qName
-            alignment = seqgraphalignment.SeqGraphAlignment(subread_seq,
-                                                            graph,
-                                                            fastMethod=True,
-                                                            globalAlign=True)
+            alignment = self._alignSubread(subread_seq, graph)
             graph.incorporateSeqAlignment(alignment, subread_seq, label=subread_label)
 
-        return graph
+    def _check_alignment_mode(self):
+        """
+        Make sure alignment mode is supported
+        """
+        if self.alignment_mode not in ['full', 'banded', 'anchored']:
+            raise ValueError("Alignment mode must be 'full', 'banded' or 'anchored'. "
+                             "No other options are currently supported.")
 
-    def _check_direction(self, seq, root_seq):
+    def _alignSubread(self, subread_seq, graph):
         """
-        Use Levenshtein distance to check whether seq should be 
-        reverse-complemented before aligning to root_seq
+        Align a subread to the graph with the configured alignment mode
         """
+        if self.alignment_mode == 'banded':
+            alignment = ga.BandedSeqGraphAlignment(subread_seq,
+                                                   graph,
+                                                   band_width=self.band_width,
+                                                   indel_rate=self.indel_rate)
+            if not alignment.overflowed:
+                self.indel_rate = 0.5 * (self.indel_rate + alignment.observedIndelRate())
+                return alignment
+            log.debug('Alignment overflowed band of ' + str(alignment.band_width) +
+                      ', falling back to full DP')
+        elif self.alignment_mode == 'anchored':
+            alignment = ga.AnchoredSeqGraphAlignment(subread_seq,
+                                                     graph,
+                                                     kmer_size=self.anchor_kmer_size)
+            if not alignment.too_few_anchors:
+                return alignment
+            log.debug('Anchors cover ' + str(round(alignment.anchored_fraction, 3)) +
+                      ' of subread, falling back to full DP')
+
+        return seqgraphalignment.SeqGraphAlignment(subread_seq,
+                                                   graph,
+                                                   fastMethod=True,
+                                                   globalAlign=True)
+
+    def _check_direction(self, seq, root_seq, root_sketch=None):
+        """
+        Check whether seq should be reverse-complemented before aligning
+        to root_seq. The strand is called from the k-mers seq and its
+        reverse complement share with root_seq, which is linear in read
+        length. Only when the two strands are too close to call is the
+        Levenshtein distance computed.
+
+        :param root_sketch: k-mer sketch of root_seq, see KmerOrientation.kmerSketch.
+                            Computed from root_seq if not provided.
+        """
+        if root_sketch is None:
+            root_sketch = ko.kmerSketch(root_seq, self.orientation_kmer_size)
+        fwd_score, rc_score = ko.strandScores(seq, root_sketch, self.orientation_kmer_size)
+        strand = ko.callStrand(fwd_score, rc_score, min_ratio=self.orientation_min_ratio)
+        if strand == 'forward':
+            return seq
+        elif strand == 'reverse':
+            return self._reverse_complement(seq)
+
+        log.debug('Shared k-mers too close to call strand, using levenshtein distance')
         og_score = ld.levenshtein_distance(seq, root_seq)
         rc = self._reverse_complement(seq)
-        rc_score = ld.levenshtein_distance(rc, root_seq)
+        # only need to know whether rc beats the forward strand
+        rc_score = ld.levenshtein_distance(rc, root_seq, max_distance=og_score)
         if og_score < rc_score:
             return seq
         else:
@@ -80,13 +167,7 @@ class POA:
         """
         return reverse-complement of sequence
         """
-        complement = {'A': 'T',
-                      'G': 'C',
-                      'T': 'A',
-                      'C': 'G'}
-        rev = seq[::-1]
-        rc = ''.join([complement[base] for base in rev])
-        return rc
+        return se.reverseComplement(seq)
 
 
 class PoaWithFeatures(POA):
@@ -97,25 +178,133 @@ class PoaWithFeatures(POA):
     in IPD and PW info to each raw subread.
     """
     def __init__(self, subreads,
-                       ref=None):
+                       ref=None,
+                       orientation_kmer_size=12,
+                       orientation_min_ratio=2.,
+                       alignment_mode='full',
+                       band_width=None,
+                       anchor_kmer_size=15,
+                       cache=None,
+                       feature_dtype=int):
+        """
+        :param cache: PoaCache. When it holds an entry for these subreads and
+                      parameters, the MSA strings and features are loaded from it
+                      and no alignment is done. PoaGraph is then None until
+                      subreads are added.
+        :param feature_dtype: integer dtype of the feature vector. np.uint16 takes a
+                              quarter of the memory of the default, with PWs and IPDs
+                              clipped to 65535 frames.
+        """
         POA.__init__(self, subreads,
-                           ref)
+                           ref,
+                           orientation_kmer_size,
+                           orientation_min_ratio,
+                           alignment_mode,
+                           band_width,
+                           anchor_kmer_size)
         self.subread_names = np.array([s.readName for s in self.subreads])
-        self.PoaGraph = self.generatePoaGraph()  # perform POA MSA
+        self.subread_lookup = dict((name, ix) for ix, name in enumerate(self.subread_names))
+        self.baseOrder = ['-ATGC']
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.cache = cache
+        cached = None
+        if self.cache is not None:
+            cache_key = self.cacheKey()
+            cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.PoaGraph = None
+            self.PoaStrings, features = cached
+            self._splitPoaStrings()
+            self.feature_vector = ([msa[0] for msa in self.MSAs],
+                                   self._castFeatures(features))
+        else:
+            self.PoaGraph = self.generatePoaGraph()  # perform POA MSA
+            self.refreshAlignment()
+            if self.cache is not None:
+                # unclipped, so the entry serves any feature_dtype
+                self.cache.put(cache_key, self.PoaStrings, self.rawFeatures()[1])
+
+    def cacheKey(self):
+        """
+        Content address of this POA in a PoaCache: the subreads in the order
+        they're aligned, the reference, and every parameter that changes the MSA.
+        feature_dtype is left out, entries hold unclipped features.
+        """
+        params = [('orientation_kmer_size', self.orientation_kmer_size),
+                  ('orientation_min_ratio', float(self.orientation_min_ratio)),
+                  ('alignment_mode', self.alignment_mode),
+                  ('band_width', self.band_width),
+                  ('anchor_kmer_size', self.anchor_kmer_size)]
+        return self.cache.key([s.qName for s in self.subreads],
+                              self.reference,
+                              params)
+
+    def refreshAlignment(self):
+        """
+        Convert the graph to MSA strings and fold in the features again,
+        after the graph has changed
+        """
         self.PoaStrings = self.PoaGraph.generateAlignmentStrings()  # convert graph to strings
         # only allow one consensus sequence
         while self.PoaStrings[-1][0] != 'Consensus0':
             self.PoaStrings.pop()
+        self._splitPoaStrings()
+        self.feature_vector = self.foldInFeatures()
 
-        if ref is not None:
+    def _splitPoaStrings(self):
+        """
+        Split PoaStrings into reference, subread and consensus rows
+        """
+        if self.reference is not None:
             self.MSAs = self.PoaStrings[1:-1]
             self.refMSA = self.PoaStrings[0]
         else:
             self.MSAs = self.PoaStrings[0:-1]
             self.refMSA = None
         self.PluralityConsensus = self.PoaStrings[-1]
-        self.feature_vector = self.foldInFeatures()
-        self.baseOrder = ['-ATGC']
+        self.consensus_codes = se.encode(self.PluralityConsensus[1])
+
+    def addSubreads(self, subreads):
+        """
+        Extend the existing graph with more subreads of the same molecule,
+        instead of redoing the POA from scratch. The MSA strings and
+        feature vector are refreshed afterwards.
+
+        :param subreads: subreads not already in the graph
+        """
+        if self.subreads is None:
+            raise ValueError('Subreads and graph were released, the POA cannot be extended.')
+        subreads = list(subreads)
+        names = [subread.readName for subread in subreads]
+        # check every name before touching the lookup, so a rejected call leaves it as it was
+        seen = set()
+        for name in names:
+            if name in self.subread_lookup:
+                raise ValueError('Subread ' + name + ' is already in the graph.')
+            if name in seen:
+                raise ValueError('Subread ' + name + ' is given more than once.')
+            seen.add(name)
+        for name in names:
+            self.subread_lookup[name] = len(self.subread_lookup)
+        if self.PoaGraph is None:  # loaded from cache, rebuild the graph to extend it
+            self.PoaGraph = self.generatePoaGraph()
+        self.subreads = list(self.subreads) + subreads
+        self.subread_names = np.concatenate((self.subread_names, names))
+        self.incorporateSubreads(self.PoaGraph, subreads)
+        self.refreshAlignment()
+
+    def releasePoa(self):
+        """
+        Drop the graph, MSA strings and subread objects once the features are
+        folded in. Only the feature vector, plurality consensus and reference
+        row are kept, so results can be held for many ZMWs at once.
+        """
+        self.PoaGraph = None
+        self.PoaStrings = None
+        self.MSAs = None
+        self.subreads = None
+        self.subread_lookup = None
+        self.root_subread = None
 
     def _baseOrder(self, base):
         """
@@ -126,6 +315,24 @@ class PoaWithFeatures(POA):
         return base_order[base]
 
     def foldInFeatures(self):
+        """
+        Feature vector of the MSA in feature_dtype, see rawFeatures
+
+        :return: (read labels, feature vector)
+        """
+        read_labels, features = self.rawFeatures()
+        return read_labels, self._castFeatures(features)
+
+    def _castFeatures(self, features):
+        """
+        Cast features to feature_dtype, clipping PWs and IPDs to its largest value
+        """
+        if features.dtype == self.feature_dtype:
+            return features
+        features = np.minimum(features, np.iinfo(self.feature_dtype).max)
+        return features.astype(self.feature_dtype)
+
+    def rawFeatures(self):
         """
         For each alignment, connect the by-base features.
         Each deleted base will have 0 stored for each feature.
@@ -134,19 +341,26 @@ class PoaWithFeatures(POA):
         The first layer in the feature_vector encodes the base-identity
         The second layer in the feature_vector encodes the PW (in frames)
         The third layer in the feature_vector encodes the IPD (in frames)
+
+        The MSA rows are encoded together into packed base codes, see
+        SequenceEncoding.encodeMSA, and the PWs and IPDs of all subreads are
+        scattered into the non-gap positions in one go.
+
+        :return: (read labels, int feature vector with unclipped PWs and IPDs)
         """
-        if len(self.MSAs) > 0:
-            feature_vector = np.zeros((len(self.MSAs), len(self.MSAs[0][1]), 3), dtype=int)
-            read_labels = []
-        for row_index, msa in enumerate(self.MSAs):
-            read_name = msa[0]
-            read_labels.append(read_name)
-            sequence = msa[1]
-            base_ixs = np.flatnonzero(np.array(list(sequence)) != '-')
-            raw_subread_ix = np.flatnonzero(self.subread_names == read_name)[0]
-            subread = self.subreads[raw_subread_ix]
-            feature_vector[row_index, :, 0] = map(self._baseOrder, sequence)
-            feature_vector[row_index, base_ixs, 1] = subread.PulseWidth(aligned=False)
-            feature_vector[row_index, base_ixs, 2] = subread.IPD(aligned=False)
-
-        return read_labels, feature_vector
\ No newline at end of file
+        read_labels = [msa[0] for msa in self.MSAs]
+        bases = se.encodeMSA([msa[1] for msa in self.MSAs])
+        nrows, ncols = bases.shape
+
+        feature_vector = np.zeros((nrows, ncols, 3), dtype=int)
+        feature_vector[:, :, 0] = bases
+        if nrows > 0:
+            subreads = [self.subreads[self.subread_lookup[name]] for name in read_labels]
+            # boolean indexing walks the rows in order, matching the concatenated reads
+            is_base = bases != 0
+            feature_vector[:, :, 1][is_base] = np.concatenate(
+                [subread.PulseWidth(aligned=False) for subread in subreads])
+            feature_vector[:, :, 2][is_base] = np.concatenate(
+                [subread.IPD(aligned=False) for subread in subreads])
+
+        return read_labels, feature_vector
@@ -0,0 +1,145 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+
+CACHE_SUFFIX = '.npz'
+
+
+def _asBytes(text):
+    """
+    Return text as a byte string, for hashing
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('ascii')
+    return text
+
+
+def _asText(text):
+    """
+    Return a stored byte string as the native str type
+    """
+    if not isinstance(text, str):
+        text = text.decode('ascii')
+    return text
+
+
+class PoaCache:
+    """
+    On-disk cache of per-ZMW POA results, so tensors with different context
+    widths, collection modes or rescaling can be rebuilt from the same MSA
+    without aligning again.
+
+    Each entry is an .npz named by the SHA-1 of its inputs (subread qNames in
+    order, reference, and POA parameters), holding the PoaStrings and the
+    feature array of PoaWithFeatures. Reading an entry refreshes its mtime.
+    When the cache grows past max_bytes, the least recently used entries
+    are removed.
+
+    Entries are written to a temporary file and renamed into place, so
+    several processes can share one cache directory.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: directory to keep entries in, created if missing
+        :param max_bytes: bound on the total size of the entries. None for no bound.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, subread_names, ref=None, params=None):
+        """
+        Content address of a POA
+
+        :param subread_names: qNames of the subreads, in the order they're aligned
+        :param ref: reference record (header and sequence), or None
+        :param params: list of (name, value) POA parameters affecting the alignment
+        :return: hex digest
+        """
+        digest = hashlib.sha1()
+        for name in subread_names:
+            digest.update(_asBytes(name) + b'\n')
+        if ref is not None:
+            digest.update(_asBytes('ref:' + ref.header + '\n'))
+            digest.update(_asBytes(str(ref.sequence)))
+        for name, value in (params or []):
+            digest.update(_asBytes('\n' + name + '=' + repr(value)))
+        return digest.hexdigest()
+
+    def path(self, key):
+        """
+        Path of the entry of a key
+        """
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+        :return: (PoaStrings, feature array), or None on a miss
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as handle:
+                entry = np.load(handle)
+                labels = entry['labels'].tolist()
+                strings = entry['strings'].tolist()
+                features = entry['features']
+            os.utime(path, None)  # mark as recently used
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        poa_strings = [(_asText(label), _asText(string))
+                       for label, string in zip(labels, strings)]
+        return poa_strings, features
+
+    def put(self, key, poa_strings, features):
+        """
+        Store the PoaStrings and feature array of a POA, then evict the least
+        recently used entries if the cache is over max_bytes
+        """
+        labels = np.array([_asBytes(label) for label, _ in poa_strings])
+        strings = np.array([_asBytes(string) for _, string in poa_strings])
+        handle, tmp_path = tempfile.mkstemp(suffix=CACHE_SUFFIX + '.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as tmp:
+                np.savez(tmp, labels=labels, strings=strings, features=features)
+            os.rename(tmp_path, self.path(key))
+        except (IOError, OSError):
+            log.warning('Could not write POA cache entry ' + key)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.max_bytes is not None:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,123 @@
+import numpy as np
+
+# Packed uint8 encoding shared by the POA stack. Codes follow the
+# '-ATGC' row order of consensus tensors and feature vectors.
+BASE_ORDER = '-ATGC'
+GAP, A, T, G, C = range(5)
+INVALID = 255
+
+# consensus tensor labels, in the order classes are balanced and sampled
+TENSOR_TYPES = ['A', 'C', 'G', 'T', '-']
+
+# byte -> base code. Anything outside '-ATGC' maps to INVALID.
+BASE_CODES = np.full(256, INVALID, dtype=np.uint8)
+for _code, _base in enumerate(BASE_ORDER):
+    BASE_CODES[ord(_base)] = _code
+
+# base code -> byte
+BASE_BYTES = np.frombuffer(BASE_ORDER.encode('ascii'), dtype=np.uint8).copy()
+
+# base code -> code of its complement. The gap is its own complement.
+COMPLEMENT_CODES = np.array([GAP, T, A, C, G], dtype=np.uint8)
+
+# byte -> complement byte, for reverse-complementing raw reads. Anything
+# that isn't ACGT maps to 0 and is rejected.
+COMPLEMENT_BYTES = np.zeros(256, dtype=np.uint8)
+for _base, _complement in zip('ACGTacgt', 'TGCAtgca'):
+    COMPLEMENT_BYTES[ord(_base)] = ord(_complement)
+
+# 2-bit k-mer encoding of nucleotides (A0 C1 G2 T3). Anything that isn't
+# ACGT maps to 4 and masks out every k-mer that covers it.
+TWO_BIT = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for _base in _bases:
+        TWO_BIT[ord(_base)] = _code
+
+
+def asBytes(seq):
+    """
+    Return sequence as a byte string, so it can be viewed with np.frombuffer
+    """
+    if not isinstance(seq, bytes):
+        seq = seq.encode('ascii')
+    return seq
+
+
+def asText(seq):
+    """
+    Return a byte string as the native str type
+    """
+    if not isinstance(seq, str):
+        seq = seq.decode('ascii')
+    return seq
+
+
+def byteView(seq):
+    """
+    View a sequence as a uint8 array of its bytes, without copying
+    """
+    return np.frombuffer(asBytes(seq), dtype=np.uint8)
+
+
+def encode(seq):
+    """
+    Encode a sequence or MSA row into base codes
+
+    :param seq: string of '-ATGC'
+    :return: uint8 array of codes 0-4
+    """
+    codes = BASE_CODES[byteView(seq)]
+    if np.any(codes == INVALID):
+        raise ValueError('Sequences may only contain the bases -ATGC.')
+    return codes
+
+
+def encodeMSA(rows):
+    """
+    Encode equal-length MSA rows into a single matrix of base codes
+
+    :param rows: list of MSA row strings
+    :return: (n_rows, msa_length) uint8 array
+    """
+    ncols = len(rows[0]) if rows else 0
+    return encode(''.join(rows)).reshape(len(rows), ncols)
+
+
+def decode(codes):
+    """
+    Decode base codes back into a string
+    """
+    return asText(BASE_BYTES[codes].tobytes())
+
+
+def reverseComplement(seq):
+    """
+    Reverse complement of a nucleotide string, through a byte lookup table
+
+    :param seq: string of ACGT
+    :return: string of the same type as a native str
+    """
+    complement = COMPLEMENT_BYTES[byteView(seq)[::-1]]
+    if np.any(complement == 0):
+        raise ValueError('Only ACGT sequences can be reverse-complemented.')
+    return asText(complement.tobytes())
+
+
+def reverseComplementCodes(codes):
+    """
+    Reverse complement of base codes
+    """
+    return COMPLEMENT_CODES[codes[::-1]]
+
+
+def labelsAt(seq, loci):
+    """
+    Single-character labels of a sequence or MSA row at the given positions,
+    taken from its bytes instead of a list of characters
+
+    :return: array of native single-character strings
+    """
+    labels = np.frombuffer(asBytes(seq), dtype='S1')[loci]
+    if str is not bytes:
+        labels = labels.astype('U1')
+    return labels
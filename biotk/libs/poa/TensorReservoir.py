@@ -0,0 +1,104 @@
+import SequenceEncoding as se
+import numpy as np
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+
+
+class StratifiedTensorReservoir:
+    """
+    Class-balanced sample of consensus tensors across a whole SubreadSet.
+
+    Each label keeps its own reservoir of target_per_label slots, filled by
+    reservoir sampling (Algorithm R) over every locus of that label offered
+    so far, from any ZMW. Every locus is offered at most once, so the sample
+    has no duplicates, and each label's sample is uniform over the loci seen.
+    A tensor is only copied out of its ZMW's column summary when the
+    reservoir accepts the locus.
+    """
+    def __init__(self, target_per_label,
+                       tensor_shape,
+                       labels=se.TENSOR_TYPES,
+                       dtype=float,
+                       seed=None):
+        """
+        :param target_per_label: number of tensors to keep of each label
+        :param tensor_shape: shape of one tensor, (5, 1 + 2 * context_width, 3)
+        :param labels: labels to balance. Loci with other labels are ignored.
+        :param dtype: dtype of the stored tensors
+        :param seed: seed of the reservoir's own random state
+        """
+        self.target_per_label = target_per_label
+        self.labels = list(labels)
+        self.random_state = np.random.RandomState(seed)
+        nlabels = len(self.labels)
+        self.tensors = np.zeros((nlabels, target_per_label) + tuple(tensor_shape), dtype=dtype)
+        self.zmws = np.full((nlabels, target_per_label), -1, dtype=int)
+        self.loci = np.full((nlabels, target_per_label), -1, dtype=int)
+        self.seen = np.zeros((nlabels, ), dtype=int)
+
+    def isFull(self):
+        """
+        True once every label has filled its reservoir
+        """
+        return bool(np.all(self.seen >= self.target_per_label))
+
+    def _acceptedSlots(self, nseen, ncandidates):
+        """
+        Run Algorithm R over a batch of candidates of one label
+
+        :param nseen: candidates of this label offered before the batch
+        :return: (candidate indices, slots) of the candidates left in the
+                 reservoir after the batch
+        """
+        positions = nseen + np.arange(ncandidates)
+        slots = np.where(positions < self.target_per_label,
+                         positions,
+                         (self.random_state.random_sample(ncandidates) * (positions + 1)).astype(int))
+        accepted = np.flatnonzero(slots < self.target_per_label)
+        # a later candidate replacing the same slot wins, keep the last of each slot
+        _, last = np.unique(slots[accepted][::-1], return_index=True)
+        accepted = accepted[::-1][last]
+        return accepted, slots[accepted]
+
+    def offer(self, zmw, windows, loci, labels):
+        """
+        Offer the loci of one ZMW to the reservoir
+
+        :param zmw: holeNumber
+        :param windows: context windows of the ZMW, see ConsensusTensor.contextWindows
+        :param loci: candidate MSA columns
+        :param labels: label of each candidate
+        :return: number of tensors accepted
+        """
+        loci = np.asarray(loci, dtype=int)
+        labels = np.asarray(labels)
+        context_width = self.tensors.shape[3] // 2
+        naccepted = 0
+        for label_ix, label in enumerate(self.labels):
+            candidates = np.flatnonzero(labels == label)
+            if candidates.size == 0:
+                continue
+            accepted, slots = self._acceptedSlots(self.seen[label_ix], candidates.size)
+            self.seen[label_ix] += candidates.size
+            accepted_loci = loci[candidates[accepted]]
+            self.tensors[label_ix, slots] = windows[accepted_loci - context_width]
+            self.zmws[label_ix, slots] = zmw
+            self.loci[label_ix, slots] = accepted_loci
+            naccepted += accepted.size
+
+        return naccepted
+
+    def sample(self):
+        """
+        Filled slots of every label
+
+        :return: (tensors, labels, zmws, loci), grouped by label
+        """
+        filled = self.zmws >= 0
+        labels = np.repeat(np.array(self.labels)[:, np.newaxis], self.target_per_label, axis=1)
+        return (self.tensors[filled],
+                labels[filled],
+                self.zmws[filled],
+                self.loci[filled])
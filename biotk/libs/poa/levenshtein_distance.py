@@ -0,0 +1,58 @@
+def _exceeds(max_distance):
+    """
+    Distance returned when the cutoff is passed
+    """
+    return max_distance + 1
+
+
+def levenshtein_distance(seq1, seq2, max_distance=None):
+    """
+    Calculate the levenshtein distance between two nucleotide sequences.
+    Used to distinguish between forward and reverse direction subreads.
+
+    Uses Myers' bit-parallel algorithm. Each column of the DP is kept as
+    vertical +1/-1 delta bit-vectors over seq1, stored in Python integers of
+    any width, so a column update is a handful of word operations instead of
+    len(seq1) cell updates.
+
+    :param max_distance: stop early once the distance is known to be above
+                         max_distance, and return max_distance + 1. Comparing
+                         the second strand against the first strand's distance
+                         only needs to know which one is smaller.
+    :return: edit distance, or max_distance + 1 if it is above max_distance
+    """
+    if len(seq1) > len(seq2):
+        seq1, seq2 = seq2, seq1
+    m, n = len(seq1), len(seq2)
+    if max_distance is not None and n - m > max_distance:
+        return _exceeds(max_distance)
+    if m == 0:
+        return n
+
+    mask = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+    peq = {}
+    for position, base in enumerate(seq1):
+        peq[base] = peq.get(base, 0) | (1 << position)
+
+    pv, mv = mask, 0  # column 0 rises by 1 per row
+    score = m
+    for column, base in enumerate(seq2):
+        eq = peq.get(base, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask  # row 0 rises by 1 per column
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        # each remaining column lowers the last row by at most 1
+        if max_distance is not None and score - (n - column - 1) > max_distance:
+            return _exceeds(max_distance)
+
+    return score
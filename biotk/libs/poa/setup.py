@@ -6,7 +6,7 @@ setup(
   name = 'Levenshtein Distance',
   ext_modules=[
     Extension('levenshtein_distance',
-              sources=['levenshtein_distance.pyx'],
+              sources=['levenshtein_distance.py'],
               extra_compile_args=['-fgnu89-inline'],
               language='c')
     ],
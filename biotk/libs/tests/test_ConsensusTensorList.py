@@ -1,4 +1,8 @@
-from biotk.libs.poa.ConsensusTensor import ConsensusTensorList
+from biotk.libs.poa.ConsensusTensor import (ConsensusTensorList,
+                                             buildConsensusTensors,
+                                             buildColumnSummary,
+                                             contextWindows,
+                                             coverageSweep)
 from biotk.libs.tests.test_PoaWithFeatures import TestPoaWithFeatures
 from pbcore.io import (ReferenceSet, SubreadSet)
 import numpy as np
@@ -81,4 +85,139 @@ def test_makeConsensusTensorsRef_FullMode():
                                           ref=ref,
                                           context_width=1,
                                           collection_mode='standard',
-                                          subsample_count=15)
\ No newline at end of file
+                                          subsample_count=15)
+
+def test_buildConsensusTensors():
+    """
+    Test that the batched tensor builder matches a column-by-column
+    summary of the feature vector
+    :return:
+    """
+    np.random.seed(0)
+    feature_vector = np.zeros((6, 30, 3), dtype=int)
+    feature_vector[:, :, 0] = np.random.randint(0, 5, size=(6, 30))
+    feature_vector[:, :, 1] = np.random.randint(0, 50, size=(6, 30))
+    feature_vector[:, :, 2] = np.random.randint(0, 90, size=(6, 30))
+    context_width = 2
+    loci = np.array([2, 10, 10, 27])
+    tensors = buildConsensusTensors(feature_vector, loci, context_width)
+    assert tensors.shape == (4, 5, 5, 3)
+    for index, locus in enumerate(loci):
+        for col_index in range(5):
+            col = feature_vector[:, locus - context_width + col_index, :]
+            for base in range(5):
+                rows = col[:, 0] == base
+                assert tensors[index, base, col_index, 0] == np.mean(rows)
+                assert tensors[index, base, col_index, 1] == np.sum(col[rows, 1])
+                assert tensors[index, base, col_index, 2] == np.sum(col[rows, 2])
+
+def test_contextWindows():
+    """
+    Test that context windows are views into the column summary
+    :return:
+    """
+    np.random.seed(1)
+    feature_vector = np.zeros((4, 12, 3), dtype=int)
+    feature_vector[:, :, 0] = np.random.randint(0, 5, size=(4, 12))
+    feature_vector[:, :, 1:] = np.random.randint(0, 50, size=(4, 12, 2))
+    column_summary = buildColumnSummary(feature_vector, dtype=np.float32)
+    assert column_summary.shape == (5, 12, 3)
+    assert np.allclose(column_summary[:, :, 0].sum(axis=0), 1.)
+    windows = contextWindows(column_summary, 3)
+    assert windows.shape == (6, 5, 7, 3)
+    assert np.may_share_memory(windows, column_summary)
+    for index in range(6):
+        assert np.array_equal(windows[index], column_summary[:, index:index + 7, :])
+
+    # overlapping windows are read-only, so editing one can't change its neighbours
+    assert not windows.flags.writeable
+    assert not windows[0].flags.writeable
+    try:
+        windows[0][:, 3, 1] *= 2
+        assert False
+    except ValueError:
+        pass
+    assert windows[[0, 1]].flags.writeable
+    column_summary[:, 3, 1] = 7
+    for index in range(4):
+        assert np.all(windows[index][:, 3 - index, 1] == 7)
+
+@with_setup(setup_func)
+def test_makeConsensusTensors_views():
+    """
+    Test that ConsensusTensor objects are views onto the column summary
+    :return:
+    """
+    tpctl = setup_func()
+    poa_tensor_list = ConsensusTensorList(tpctl.poa.subreads,
+                                          context_width=1)
+    assert poa_tensor_list.tensors.shape[1:] == (5, 3, 3)
+    assert len(poa_tensor_list.labels) == poa_tensor_list.tensors.shape[0]
+    assert np.array_equal(poa_tensor_list.tensors[0],
+                          poa_tensor_list.consensus_tensor_list[0].tensor)
+    poa_tensor_list.column_summary[0, poa_tensor_list.loci[0] - 1, 0] = -1.
+    assert poa_tensor_list.consensus_tensor_list[0].tensor[0, 0, 0] == -1.
+    poa_tensor_list = ConsensusTensorList(tpctl.poa.subreads,
+                                          tensor_objects=False)
+    assert poa_tensor_list.consensus_tensor_list is None
+
+@with_setup(setup_func)
+def test_addSubreads():
+    """
+    Test that subreads can be added to an existing graph, and that
+    subreads already in it, or given twice, are rejected without
+    recording any of the call's subreads
+    :return:
+    """
+    tpctl = setup_func()
+    subreads = list(tpctl.poa.subreads)
+    poa_tensor_list = ConsensusTensorList(subreads[:3])
+    for rejected in ([subreads[3], subreads[0]], [subreads[3], subreads[3]]):
+        try:
+            poa_tensor_list.addSubreads(rejected)
+            assert False
+        except ValueError:
+            pass
+    assert poa_tensor_list.depth() == 3
+    poa_tensor_list.addSubreads(subreads[3:])
+    assert poa_tensor_list.depth() == len(subreads)
+    assert poa_tensor_list.feature_vector[1].shape[0] == len(subreads)
+    assert len(poa_tensor_list.labels) == poa_tensor_list.tensors.shape[0]
+    try:
+        poa_tensor_list.addSubreads(subreads[:1])
+        assert False
+    except ValueError:
+        pass
+
+@with_setup(setup_func)
+def test_coverageSweep():
+    """
+    Test that a sweep yields every depth from min_depth up
+    :return:
+    """
+    tpctl = setup_func()
+    subreads = list(tpctl.poa.subreads)
+    depths = []
+    for depth, poa_tensor_list in coverageSweep(subreads, min_depth=3, context_width=1):
+        assert poa_tensor_list.tensors.shape[1:] == (5, 3, 3)
+        depths.append(depth)
+    assert depths == list(range(3, len(subreads) + 1))
+
+@with_setup(setup_func)
+def test_compact_tensor_list():
+    """
+    Test float32/uint16 storage, and that the POA can be released once
+    the tensors are built
+    :return:
+    """
+    tpctl = setup_func()
+    poa_tensor_list = ConsensusTensorList(tpctl.poa.subreads,
+                                          tensor_dtype=np.float32,
+                                          feature_dtype=np.uint16,
+                                          release_poa=True)
+    assert poa_tensor_list.tensors.dtype == np.float32
+    assert poa_tensor_list.feature_vector[1].dtype == np.uint16
+    assert poa_tensor_list.PoaGraph is None
+    assert poa_tensor_list.subreads is None
+    assert poa_tensor_list.depth() == poa_tensor_list.feature_vector[1].shape[0]
+    assert not hasattr(poa_tensor_list.consensus_tensor_list[0], '__dict__')
@@ -79,6 +79,12 @@ def test_check_direction():
     assert seq1 == test_poa.poa._check_direction(seq1, seq2)
     # case 2: rev
     assert seq1 == test_poa.poa._check_direction(seq2_rc, seq2)
+    # case 3: long enough for the strand to be called from shared k-mers
+    np.random.seed(0)
+    seq3 = ''.join(np.random.choice(list('ACGT'), 300))
+    seq3_rc = test_poa.poa._reverse_complement(seq3)
+    assert seq3 == test_poa.poa._check_direction(seq3[20:280], seq3)
+    assert seq3[20:280] == test_poa.poa._check_direction(seq3_rc[20:280], seq3)
 
 @with_setup(setup_func)
 def test_reverse_complement():
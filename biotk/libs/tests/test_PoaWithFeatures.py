@@ -1,6 +1,11 @@
 from biotk.libs.poa import POA as poa
+from biotk.libs.poa import PoaCache as pc
 from biotk.libs.tests.test_POA import TestPOA
 from nose.tools import with_setup
+import numpy as np
+import shutil
+import tempfile
+import os
 
 class TestPoaWithFeatures(TestPOA):
     def connectIpdAndPw(self):
@@ -24,3 +29,49 @@ def test_foldInFeatures():
     """
     tpwf = setup_func()
     tpwf.connectIpdAndPw().foldInFeatures()
+
+@with_setup(setup_func)
+def test_foldInFeatures_layout():
+    """
+    Test that the base layer matches the MSA rows, and that every
+    non-gap position carries the PW and IPD of its subread
+    """
+    tpwf = setup_func()
+    poa_with_features = tpwf.connectIpdAndPw()
+    read_labels, feature_vector = poa_with_features.foldInFeatures()
+    assert feature_vector.shape[:2] == (len(poa_with_features.MSAs),
+                                        len(poa_with_features.MSAs[0][1]))
+    for row_index, msa in enumerate(poa_with_features.MSAs):
+        assert read_labels[row_index] == msa[0]
+        bases = [poa_with_features._baseOrder(base) for base in msa[1]]
+        assert list(feature_vector[row_index, :, 0]) == bases
+        subread = poa_with_features.subreads[poa_with_features.subread_lookup[msa[0]]]
+        base_ixs = np.flatnonzero(feature_vector[row_index, :, 0] != 0)
+        assert list(feature_vector[row_index, base_ixs, 1]) == list(subread.PulseWidth(aligned=False))
+        assert list(feature_vector[row_index, base_ixs, 2]) == list(subread.IPD(aligned=False))
+
+@with_setup(setup_func)
+def test_cached_poa():
+    """
+    Test that a second POA of the same subreads is loaded from the cache
+    without building a graph
+    """
+    tpwf = setup_func()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = pc.PoaCache(cache_dir)
+        aligned = poa.PoaWithFeatures(tpwf.zmw_subreads, cache=cache)
+        cached = poa.PoaWithFeatures(tpwf.zmw_subreads, cache=cache)
+        assert cached.PoaGraph is None
+        assert cached.PoaStrings == aligned.PoaStrings
+        assert cached.feature_vector[0] == aligned.feature_vector[0]
+        assert np.array_equal(cached.feature_vector[1], aligned.feature_vector[1])
+        # a different storage dtype reuses the alignment, cast on load
+        compact = poa.PoaWithFeatures(tpwf.zmw_subreads, cache=cache, feature_dtype=np.uint8)
+        assert compact.PoaGraph is None
+        assert compact.feature_vector[1].dtype == np.uint8
+        assert np.array_equal(compact.feature_vector[1],
+                              np.minimum(aligned.feature_vector[1], 255))
+        assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(cache_dir)
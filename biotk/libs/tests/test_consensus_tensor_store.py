@@ -0,0 +1,193 @@
+from biotk.libs.poa import ConsensusTensorStore as cts
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+
+def _zmw_tensors(zmw, n, context_width=1):
+    tensors = np.full((n, 5, 1 + 2 * context_width, 3), zmw, dtype=float)
+    labels = np.array(list('ACGT-' * n)[:n])
+    loci = np.arange(n) + 10
+    return tensors, labels, loci
+
+def test_shard_writer():
+    """
+    Test that tensors are appended across fixed-size shards, and that the
+    manifest records where each ZMW landed
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=4)
+        for zmw, n in [(7, 3), (8, 0), (9, 6)]:
+            writer.write(zmw, *_zmw_tensors(zmw, n))
+        writer.close()
+
+        manifest = cts.readManifest(output_dir)
+        assert list(manifest['zmw']) == [7, 8, 9]
+        assert list(manifest['shard']) == [0, 0, 0]
+        assert list(manifest['offset']) == [0, 3, 3]
+        assert list(manifest['count']) == [3, 0, 6]
+        tensors = np.load(cts.shardPath(output_dir, 'tensors', 1), mmap_mode='r')
+        assert tensors.dtype == np.float32
+        assert tensors.shape == (4, 5, 3, 3)
+        assert np.all(tensors[:3] == 9)
+        zmws = np.load(cts.shardPath(output_dir, 'zmws', 0), mmap_mode='r')
+        assert list(zmws) == [7, 7, 7, 9]
+        loci = np.load(cts.shardPath(output_dir, 'loci', 1), mmap_mode='r')
+        assert list(loci[:3]) == [11, 12, 13]
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_shard_writer_resume():
+    """
+    Test that reopening a dataset skips completed ZMWs and ignores
+    a manifest line left incomplete by an interrupted run
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=4)
+        writer.write(7, *_zmw_tensors(7, 3))
+        writer.close()
+        with open(os.path.join(output_dir, cts.MANIFEST_FILE), 'a') as manifest_file:
+            manifest_file.write('9\t0\t3')  # interrupted mid-line
+
+        writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=4)
+        assert writer.isComplete(7)
+        assert not writer.isComplete(9)
+        assert writer.count == 3
+        writer.write(7, *_zmw_tensors(7, 3))
+        writer.write(9, *_zmw_tensors(9, 2))
+        writer.close()
+        manifest = cts.readManifest(output_dir)
+        assert list(manifest['zmw']) == [7, 9]
+        assert list(manifest['shard']) == [0, 0]
+        assert list(manifest['offset']) == [0, 3]
+
+        # a complete manifest is left as is, and no temporary file remains
+        manifest_path = os.path.join(output_dir, cts.MANIFEST_FILE)
+        inode = os.stat(manifest_path).st_ino
+        cts.ConsensusTensorShardWriter(output_dir, shard_size=4).close()
+        assert os.stat(manifest_path).st_ino == inode
+        assert not [name for name in os.listdir(output_dir) if name.endswith('.tmp')]
+
+        try:
+            cts.ConsensusTensorShardWriter(output_dir, shard_size=8)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_shard_writer_resume_parsable_partial_line():
+    """
+    Test that a last manifest line cut inside its final number is ignored,
+    although it still has four fields
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=16)
+        writer.write(7, *_zmw_tensors(7, 3))
+        writer.close()
+        with open(os.path.join(output_dir, cts.MANIFEST_FILE), 'a') as manifest_file:
+            manifest_file.write('9\t0\t3\t1')  # '9\t0\t3\t12\n' interrupted
+
+        assert list(cts.readManifest(output_dir)['zmw']) == [7]
+        writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=16)
+        assert not writer.isComplete(9)
+        assert writer.count == 3
+        writer.write(9, *_zmw_tensors(9, 12))
+        writer.close()
+        manifest = cts.readManifest(output_dir)
+        assert list(manifest['zmw']) == [7, 9]
+        assert list(manifest['offset']) == [0, 3]
+        assert list(manifest['count']) == [3, 12]
+    finally:
+        shutil.rmtree(output_dir)
+
+def _write_dataset(output_dir):
+    writer = cts.ConsensusTensorShardWriter(output_dir, shard_size=7)
+    for zmw in range(6):
+        tensors, labels, loci = _zmw_tensors(zmw, 5)
+        writer.write(zmw, tensors, labels, loci)
+    writer.close()
+
+def test_shard_reader():
+    """
+    Test that a shuffled epoch visits every tensor once, with labels
+    kept alongside their tensors
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        _write_dataset(output_dir)
+        reader = cts.ConsensusTensorShardReader(output_dir, batch_size=6, seed=0)
+        assert len(reader) == 30
+        assert reader.nBatches() == 5
+        seen = []
+        for tensors, labels in reader.iterBatches():
+            assert tensors.shape == (6, 5, 3, 3)
+            seen.extend(tensors[:, 0, 0, 0].tolist())
+        assert sorted(seen) == sorted(np.repeat(np.arange(6), 5).tolist())
+
+        tensors, labels = reader.gather([13, 2, 29])
+        assert list(tensors[:, 0, 0, 0]) == [0, 2, 5]
+        assert list(labels) == list(np.array(['G', 'T', '-'], dtype='S1'))
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_shard_reader_equal_state():
+    """
+    Test that equal-state batches are balanced across labels
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        _write_dataset(output_dir)
+        reader = cts.ConsensusTensorShardReader(output_dir,
+                                                batch_size=10,
+                                                collection_mode='equal-state',
+                                                prefetch=0,
+                                                seed=0)
+        for tensors, labels in reader.iterBatches():
+            types, counts = np.unique(labels, return_counts=True)
+            assert len(types) == 5
+            assert np.all(counts == 2)
+    finally:
+        shutil.rmtree(output_dir)
+
+def test_iterInBackground():
+    """
+    Test that background iteration keeps order and re-raises errors
+    """
+    assert list(cts.iterInBackground(iter(range(20)), 3)) == list(range(20))
+
+    def failing():
+        yield 1
+        raise IOError('truncated BAM')
+    items = cts.iterInBackground(failing(), 2)
+    assert next(items) == 1
+    try:
+        next(items)
+        assert False
+    except IOError:
+        pass
+
+def test_iterInBackground_close():
+    """
+    Test that closing a background iteration waits for the item being
+    drawn, and draws no further item
+    """
+    drawn = []
+
+    def slow():
+        for item in range(100):
+            time.sleep(0.01)
+            drawn.append(item)
+            yield item
+    items = cts.iterInBackground(slow(), 2)
+    assert next(items) == 0
+    items.close()
+    count = len(drawn)
+    time.sleep(0.1)
+    assert len(drawn) == count
+    assert count < 100
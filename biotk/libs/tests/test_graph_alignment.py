@@ -0,0 +1,99 @@
+from biotk.libs.poa import GraphAlignment as ga
+import poagraph
+import seqgraphalignment
+import numpy as np
+
+
+def _mutate(seq, rate):
+    """
+    Introduce substitutions, insertions and deletions at a combined rate
+    """
+    mutated = []
+    for base in seq:
+        draw = np.random.rand()
+        if draw < rate / 3:
+            continue
+        elif draw < 2 * rate / 3:
+            mutated.append(np.random.choice(list('ACGT')))
+            mutated.append(base)
+        elif draw < rate:
+            mutated.append(np.random.choice(list('ACGT')))
+        else:
+            mutated.append(base)
+    return ''.join(mutated)
+
+def _alignment_score(seq, graph, alignment):
+    score = 0
+    for string_ix, node_id in zip(alignment.stringidxs, alignment.nodeidxs):
+        if string_ix is None or node_id is None:
+            score += ga.GAP_SCORE
+        elif seq[string_ix] == graph.nodedict[node_id].base:
+            score += ga.MATCH_SCORE
+        else:
+            score += ga.MISMATCH_SCORE
+    return score
+
+def test_banded_alignment_matches_full():
+    """
+    Test that a banded alignment wide enough for the subreads scores as
+    well as the full DP, while growing a graph from several subreads
+    """
+    np.random.seed(1)
+    template = ''.join(np.random.choice(list('ACGT'), 150))
+    graph = poagraph.POAGraph(_mutate(template, 0.1), label='root')
+    for index in range(4):
+        seq = _mutate(template, 0.1)
+        banded = ga.BandedSeqGraphAlignment(seq, graph, band_width=24)
+        full = seqgraphalignment.SeqGraphAlignment(seq, graph, fastMethod=True, globalAlign=True)
+        assert not banded.overflowed
+        assert [ix for ix in banded.stringidxs if ix is not None] == list(range(len(seq)))
+        assert _alignment_score(seq, graph, banded) == banded.score
+        assert banded.score == _alignment_score(seq, graph, full)
+        graph.incorporateSeqAlignment(banded, seq, label='subread' + str(index))
+
+def test_banded_alignment_overflow():
+    """
+    Test that a band too narrow for the length difference is flagged
+    """
+    graph = poagraph.POAGraph('ACGT' * 20, label='root')
+    banded = ga.BandedSeqGraphAlignment('ACGT' * 5, graph, band_width=3)
+    assert banded.overflowed
+
+def test_adaptiveBandWidth():
+    assert ga.adaptiveBandWidth(100, 100, 0., min_band_width=8) == 8
+    assert ga.adaptiveBandWidth(10000, 9900, 0.16) == 100 + 160
+
+def test_globalPairwiseAlignment():
+    seq1 = np.frombuffer(b'ACGTTGCA', dtype=np.uint8)
+    seq2 = np.frombuffer(b'ACGTGCA', dtype=np.uint8)
+    score, pairs = ga.globalPairwiseAlignment(seq1, seq2)
+    assert score == 7 * ga.MATCH_SCORE + ga.GAP_SCORE
+    assert [ix for ix, _ in pairs if ix is not None] == list(range(8))
+    assert [ix for _, ix in pairs if ix is not None] == list(range(7))
+    score, pairs = ga.globalPairwiseAlignment(seq1[:0], seq2)
+    assert score == 7 * ga.GAP_SCORE
+    assert pairs == [(None, ix) for ix in range(7)]
+
+def test_chainAnchors():
+    anchors = np.array([[0, 0], [50, 10], [20, 20], [30, 30], [5, 40]])
+    chained = ga.chainAnchors(anchors)
+    assert chained.tolist() == [[0, 0], [20, 20], [30, 30]]
+
+def test_anchored_alignment():
+    """
+    Test that anchored alignment to a single-path graph scores as well as
+    the full DP, and that unrelated sequence falls back
+    """
+    np.random.seed(2)
+    template = ''.join(np.random.choice(list('ACGT'), 300))
+    graph = poagraph.POAGraph(template, label='root')
+    seq = _mutate(template, 0.05)
+    anchored = ga.AnchoredSeqGraphAlignment(seq, graph, kmer_size=10)
+    full = seqgraphalignment.SeqGraphAlignment(seq, graph, fastMethod=True, globalAlign=True)
+    assert not anchored.too_few_anchors
+    assert [ix for ix in anchored.stringidxs if ix is not None] == list(range(len(seq)))
+    assert _alignment_score(seq, graph, anchored) == anchored.score
+    assert anchored.score == _alignment_score(seq, graph, full)
+
+    unrelated = ''.join(np.random.choice(list('ACGT'), 300))
+    assert ga.AnchoredSeqGraphAlignment(unrelated, graph, kmer_size=10).too_few_anchors
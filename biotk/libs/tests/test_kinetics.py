@@ -1,25 +1,55 @@
-from biotk.libs.QuickKinetics import kinetics
+from biotk.libs.QuickKinetics import (kinetics,
+                                      summarizeBaseKinetics,
+                                      contextCodes,
+                                      contextLabels,
+                                      startFrames,
+                                      timeBaseCodes)
 import pandas as pd
+import numpy as np
 
 class TestKinetics:
 
     def __init__(self, sset_path,
                        nreads=None,
                        samples_per_read=None,
-                       unique_zmws=False):
+                       unique_zmws=False,
+                       sampling='random'):
         self.sset_path = sset_path
         self.kinetics = kinetics(self.sset_path,
                                  nreads,
                                  samples_per_read,
-                                 unique_zmws)
+                                 unique_zmws,
+                                 sampling=sampling)
+
+class ReadWithFrames:
+    """
+    Stand-in for a subread record carrying sf/pc tags
+    """
+    class peer:
+        pass
+
+    class readGroupInfo:
+        FrameRate = 100.
+
+    def __init__(self, sequence, tags):
+        self.sequence = sequence
+        self.readName = 'movie/1/0_' + str(len(sequence))
+        self.peer = ReadWithFrames.peer()
+        self.peer.has_tag = lambda tag: tag in tags
+        self.peer.get_tag = lambda tag: tags[tag]
+
+    def read(self, aligned=True):
+        return self.sequence
 
 def setup_func(nreads=None,
                samples_per_read=None,
-               unique_zmws=False):
+               unique_zmws=False,
+               sampling='random'):
     test_kin = TestKinetics('data/tiny_set_internal.subreadset.xml',
                             nreads,
                             samples_per_read,
-                            unique_zmws)
+                            unique_zmws,
+                            sampling)
     return test_kin
 
 def test__getSubreadIndices():
@@ -33,3 +63,88 @@ def test_getKinetics():
     test_kin = setup_func(nreads=10,
                           unique_zmws=False)
     test_kin.kinetics.summarizeKinetics()
+
+def test_reservoirSample():
+    test_kin = setup_func(nreads=10,
+                          unique_zmws=True,
+                          sampling='sequential')
+    reads = test_kin.kinetics._reservoirSample()
+    zmws = [read.holeNumber for read in reads]
+    assert len(zmws) == min(10, len(set(test_kin.kinetics.sset.index['holeNumber'])))
+    assert len(set(zmws)) == len(zmws)
+    # without a cap, every read is scanned and kept
+    test_kin = setup_func(sampling='sequential')
+    blocks = list(test_kin.kinetics._scanBlocks())
+    assert sum(len(bases) for bases, _, _ in blocks) == sum(test_kin.kinetics.sset.index['qEnd'] -
+                                                           test_kin.kinetics.sset.index['qStart'])
+    try:
+        setup_func(sampling='seek')
+        assert False
+    except ValueError:
+        pass
+
+def test_summarizeBaseKinetics():
+    np.random.seed(0)
+    bases = np.random.choice([ord(base) for base in 'ACGT'], 1000).astype(np.uint8)
+    ipds = np.random.randint(0, 100, 1000)
+    pws = np.random.randint(0, 20, 1000)
+    summary = summarizeBaseKinetics(bases, ipds, pws)
+    assert list(summary.index) == ['A', 'C', 'G', 'T']
+    assert list(summary.columns) == ['IPD_mean', 'PW_mean',
+                                     'IPD_median', 'PW_median',
+                                     'IPD_std', 'PW_std']
+    # same statistics as a pandas groupby
+    table = pd.DataFrame({'base': [chr(base) for base in bases],
+                          'IPD': ipds,
+                          'PW': pws})
+    gb = table.groupby(by='base')
+    for name in ['IPD', 'PW']:
+        assert np.allclose(summary[name + '_mean'], gb[name].mean())
+        assert np.allclose(summary[name + '_median'], gb[name].median())
+        assert np.allclose(summary[name + '_std'], gb[name].std())
+    # single observation has no std
+    summary = summarizeBaseKinetics(np.array([ord('A')], dtype=np.uint8), [3], [4])
+    assert summary.loc['A', 'IPD_median'] == 3
+    assert np.isnan(summary.loc['A', 'PW_std'])
+
+def test_contextCodes():
+    labels = contextLabels(3)
+    assert len(labels) == 64
+    assert labels[0] == 'AAA' and labels[-1] == 'TTT'
+    # two reads laid end to end, contexts stop at read ends and non-ACGT bases
+    codes = contextCodes('ACGTAC' + 'GGNTTA', 3, lengths=[6, 6])
+    contexts = [labels[code] if code >= 0 else None for code in codes]
+    assert contexts == [None, 'ACG', 'CGT', 'GTA', 'TAC', None,
+                        None, None, None, None, 'TTA', None]
+    assert list(contextCodes('ACGTA', 5)) == [-1, -1, labels.index('ACG') * 4**2 + 3 * 4 + 0, -1, -1]
+    try:
+        contextCodes('ACGT', 4)
+        assert False
+    except ValueError:
+        pass
+
+def test_summarizeContextKinetics():
+    test_kin = setup_func(nreads=10)
+    summary = test_kin.kinetics.summarizeContextKinetics(context_size=3)
+    assert summary.index.name == 'context'
+    assert all(len(context) == 3 for context in summary.index)
+
+def test_startFrames():
+    read = ReadWithFrames('ACG', {'sf': [5, 10, 20]})
+    assert list(startFrames(read)) == [5, 10, 20]
+    # squashed pulses are dropped through the pulse calls
+    read = ReadWithFrames('GGA', {'sf': [0, 10, 700, 800, 20], 'pc': 'GgGaA'})
+    assert list(startFrames(read)) == [0, 700, 20]
+    try:
+        startFrames(ReadWithFrames('AC', {'sf': [1, 2, 3]}))
+        assert False
+    except ValueError:
+        pass
+
+def test_timeBaseCodes():
+    # frames at 100 fps: A at 0 s, C at 500 s, G at 1000 s, T at 5000 s
+    reads = [ReadWithFrames('ACGT', {'sf': [0, 50000, 100000, 500000]}),
+             ReadWithFrames('NA', {'sf': [0, 100]})]
+    codes = timeBaseCodes(reads, 'ACGTNA', time_bin=600., ntime_bins=6)
+    # time bin * 4 + base code (A0 C1 G2 T3), -1 past the last bin or for N
+    assert list(codes) == [0, 1, 4 + 2, -1, -1, 0]
@@ -0,0 +1,56 @@
+from biotk.libs.KineticsAccumulator import KineticsAccumulator, logBinEdges
+from biotk.libs.QuickKinetics import summarizeBaseKinetics
+import numpy as np
+import tempfile
+import os
+
+
+def setup_func(n=10000):
+    np.random.seed(0)
+    bases = np.random.choice([ord(base) for base in 'ACGT'], n).astype(np.uint8)
+    ipds = np.random.lognormal(3, 1, n).astype(int)
+    pws = np.random.lognormal(2, 0.5, n).astype(int)
+    return bases, ipds, pws
+
+def test_logBinEdges():
+    edges = logBinEdges(max_value=1000, nbins=100)
+    assert edges[0] == 0
+    assert edges[-1] == 1000
+    assert np.all(np.diff(edges) >= 1)
+
+def test_summary():
+    bases, ipds, pws = setup_func()
+    exact = summarizeBaseKinetics(bases, ipds, pws)
+    online = KineticsAccumulator().add(bases, ipds, pws).summary()
+    assert list(online.index) == list(exact.index)
+    assert list(online.columns) == list(exact.columns)
+    for name in ['IPD', 'PW']:
+        assert np.allclose(online[name + '_mean'], exact[name + '_mean'])
+        assert np.allclose(online[name + '_std'], exact[name + '_std'])
+        # medians are read from the histogram, accurate to a bin
+        assert np.allclose(online[name + '_median'], exact[name + '_median'], rtol=0.03, atol=1)
+
+def test_merge():
+    bases, ipds, pws = setup_func()
+    whole = KineticsAccumulator().add(bases, ipds, pws)
+    first = KineticsAccumulator().add(bases[:3000], ipds[:3000], pws[:3000])
+    second = KineticsAccumulator().add(bases[3000:], ipds[3000:], pws[3000:])
+    merged = second.merge(first)
+    assert np.array_equal(merged.counts, whole.counts)
+    assert np.array_equal(merged.sums, whole.sums)
+    assert np.array_equal(merged.squares, whole.squares)
+    assert np.array_equal(merged.histograms, whole.histograms)
+    try:
+        merged.merge(KineticsAccumulator(nbins=10))
+        assert False
+    except ValueError:
+        pass
+
+def test_save_load():
+    bases, ipds, pws = setup_func(n=100)
+    accumulator = KineticsAccumulator().add(bases, ipds, pws)
+    path = os.path.join(tempfile.mkdtemp(), 'kinetics.npz')
+    accumulator.save(path)
+    loaded = KineticsAccumulator.load(path)
+    assert np.array_equal(loaded.histograms, accumulator.histograms)
+    assert loaded.summary().equals(accumulator.summary())
@@ -0,0 +1,39 @@
+from biotk.libs.poa import KmerOrientation as ko
+import numpy as np
+
+
+def _random_sequence(length, seed=0):
+    np.random.seed(seed)
+    return ''.join(np.random.choice(list('ACGT'), length))
+
+def test_kmerCodes():
+    """
+    Test that forward and reverse-complement k-mer codes are computed
+    together, and that k-mers covering non-ACGT bases are dropped
+    :return:
+    """
+    fwd, rc = ko.kmerCodes('ACGTT', 3)
+    # ACG=0b000110, CGT=0b011011, GTT=0b101111
+    assert list(fwd) == [6, 27, 47]
+    # CGT, ACG, AAC are the reverse complements
+    assert list(rc) == [27, 6, 1]
+    fwd, rc = ko.kmerCodes('ACNGTT', 3)
+    assert list(fwd) == [47]
+    fwd, rc = ko.kmerCodes('AC', 3)
+    assert len(fwd) == 0 and len(rc) == 0
+
+def test_strandScores():
+    """
+    Test that a read shares k-mers with the reference on the correct strand
+    :return:
+    """
+    ref = _random_sequence(500)
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+    rc = ''.join([complement[base] for base in ref[::-1]])
+    sketch = ko.kmerSketch(ref, 12)
+    fwd_score, rc_score = ko.strandScores(ref[50:450], sketch, 12)
+    assert ko.callStrand(fwd_score, rc_score) == 'forward'
+    fwd_score, rc_score = ko.strandScores(rc[50:450], sketch, 12)
+    assert ko.callStrand(fwd_score, rc_score) == 'reverse'
+    assert ko.callStrand(10, 9) is None
+    assert ko.callStrand(0, 0) is None
@@ -0,0 +1,42 @@
+from biotk.libs.poa.levenshtein_distance import levenshtein_distance
+import numpy as np
+
+
+def _reference_distance(seq1, seq2):
+    row = list(range(len(seq2) + 1))
+    for i, base1 in enumerate(seq1):
+        previous, row = row, [i + 1]
+        for j, base2 in enumerate(seq2):
+            row.append(min(previous[j + 1] + 1,
+                           row[j] + 1,
+                           previous[j] + (base1 != base2)))
+    return row[-1]
+
+def test_known_distances():
+    assert levenshtein_distance('ACGT', 'ACGT') == 0
+    assert levenshtein_distance('ACGT', 'AGGT') == 1
+    assert levenshtein_distance('ACGT', 'ACT') == 1
+    assert levenshtein_distance('GATTACA', 'GCATGCT') == 4
+    assert levenshtein_distance('', 'ACG') == 3
+    assert levenshtein_distance('ACG', '') == 3
+    assert levenshtein_distance('', '') == 0
+
+def test_random_against_reference():
+    np.random.seed(0)
+    for _ in range(50):
+        seq1 = ''.join(np.random.choice(list('ACGT'), np.random.randint(1, 80)))
+        seq2 = ''.join(np.random.choice(list('ACGT'), np.random.randint(1, 80)))
+        expected = _reference_distance(seq1, seq2)
+        assert levenshtein_distance(seq1, seq2) == expected
+
+def test_max_distance():
+    np.random.seed(1)
+    seq1 = ''.join(np.random.choice(list('ACGT'), 200))
+    seq2 = ''.join(np.random.choice(list('ACGT'), 180))
+    expected = _reference_distance(seq1, seq2)
+    # below the distance, the cutoff is reported
+    assert levenshtein_distance(seq1, seq2, max_distance=10) == 11
+    assert levenshtein_distance(seq1, seq2, max_distance=expected - 1) == expected
+    # at or above the distance, the exact distance is returned
+    assert levenshtein_distance(seq1, seq2, max_distance=expected) == expected
+    assert levenshtein_distance(seq1, seq2, max_distance=expected + 5) == expected
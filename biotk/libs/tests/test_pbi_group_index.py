@@ -0,0 +1,49 @@
+from biotk.libs.PbiGroupIndex import PbiGroupIndex
+import numpy as np
+
+
+def test_rows():
+    """
+    Test that each key's rows come back in file order, and that
+    missing keys give no rows
+    """
+    hole_numbers = np.array([5, 3, 5, 9, 3, 5])
+    index = PbiGroupIndex(hole_numbers)
+    assert list(index.keys) == [3, 5, 9]
+    assert list(index.sizes()) == [2, 3, 1]
+    assert list(index.rows(5)) == [0, 2, 5]
+    assert list(index.rows(9)) == [3]
+    assert len(index.rows(4)) == 0
+    assert 3 in index and 4 not in index
+    for key in index.keys:
+        assert list(index.rows(key)) == list(np.flatnonzero(hole_numbers == key))
+
+def test_countWhere():
+    """
+    Test that masked rows are counted per key
+    """
+    index = PbiGroupIndex(np.array([5, 3, 5, 9, 3, 5]))
+    context_flags = np.array([3, 3, 0, 3, 1, 3])
+    assert list(index.countWhere(context_flags == 3)) == [1, 2, 1]
+
+def test_sumWhere():
+    index = PbiGroupIndex(np.array([5, 3, 5, 9, 3, 5]))
+    lengths = np.array([10, 20, 30, 40, 50, 60])
+    assert list(index.sumWhere(lengths)) == [70, 100, 40]
+    context_flags = np.array([3, 3, 0, 3, 1, 3])
+    assert list(index.sumWhere(lengths, context_flags == 3)) == [20, 70, 40]
+
+def test_sampleRows():
+    """
+    Test that one row of each key is picked
+    """
+    hole_numbers = np.array([5, 3, 5, 9, 3, 5])
+    index = PbiGroupIndex(hole_numbers)
+    rows = index.sampleRows(np.random.RandomState(0))
+    assert list(hole_numbers[rows]) == [3, 5, 9]
+
+def test_empty():
+    index = PbiGroupIndex(np.array([], dtype=int))
+    assert len(index) == 0
+    assert len(index.rows(1)) == 0
+    assert len(index.countWhere(np.array([], dtype=bool))) == 0
@@ -0,0 +1,60 @@
+from biotk.libs.poa import PoaCache as pc
+import numpy as np
+import os
+import shutil
+import tempfile
+
+
+def _poa_entry(n_reads, n_columns=6):
+    poa_strings = [('m/1/' + str(index), 'AC-GTA'[:n_columns]) for index in range(n_reads)]
+    poa_strings.append(('Consensus0', 'AC-GTA'[:n_columns]))
+    features = np.arange(n_reads * n_columns * 3).reshape(n_reads, n_columns, 3)
+    return poa_strings, features
+
+def test_key():
+    """
+    Test that keys change with subread order, reference and parameters
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = pc.PoaCache(cache_dir)
+        key = cache.key(['a', 'b'], params=[('alignment_mode', 'full')])
+        assert key == cache.key(['a', 'b'], params=[('alignment_mode', 'full')])
+        assert key != cache.key(['b', 'a'], params=[('alignment_mode', 'full')])
+        assert key != cache.key(['a', 'b'], params=[('alignment_mode', 'banded')])
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_put_get():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = pc.PoaCache(cache_dir)
+        assert cache.get('missing') is None
+        poa_strings, features = _poa_entry(3)
+        cache.put('entry', poa_strings, features)
+        assert 'entry' in cache
+        cached_strings, cached_features = cache.get('entry')
+        assert cached_strings == poa_strings
+        assert np.array_equal(cached_features, features)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_evict():
+    """
+    Test that the least recently used entries go first when the cache
+    is over its size bound
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = pc.PoaCache(cache_dir)
+        for index, key in enumerate(['old', 'used', 'new']):
+            cache.put(key, *_poa_entry(3))
+            os.utime(cache.path(key), (index, index))
+        cache.get('used')  # refreshes its mtime past 'new'
+        cache.max_bytes = 2 * os.path.getsize(cache.path('old'))
+        cache.evict()
+        assert 'old' not in cache
+        assert 'new' in cache
+        assert 'used' in cache
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,34 @@
+from biotk.libs.poa import SequenceEncoding as se
+import numpy as np
+
+
+def test_encode_decode():
+    codes = se.encode('-ATGC')
+    assert codes.dtype == np.uint8
+    assert list(codes) == [se.GAP, se.A, se.T, se.G, se.C]
+    assert se.decode(codes) == '-ATGC'
+    try:
+        se.encode('ACNT')
+        assert False
+    except ValueError:
+        pass
+
+def test_encodeMSA():
+    msa = se.encodeMSA(['AC-T', '-CGT'])
+    assert msa.shape == (2, 4)
+    assert se.decode(msa[1]) == '-CGT'
+    assert se.encodeMSA([]).shape == (0, 0)
+
+def test_reverseComplement():
+    assert se.reverseComplement('AACGTT') == 'AACGTT'
+    assert se.reverseComplement('GATTC') == 'GAATC'
+    assert se.decode(se.reverseComplementCodes(se.encode('GA-TTC'))) == 'GAA-TC'
+    try:
+        se.reverseComplement('ACNT')
+        assert False
+    except ValueError:
+        pass
+
+def test_labelsAt():
+    labels = se.labelsAt('AC-GT', np.array([4, 2, 0]))
+    assert list(labels) == ['T', '-', 'A']
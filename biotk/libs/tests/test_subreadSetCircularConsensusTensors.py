@@ -1,6 +1,12 @@
-from biotk.libs.poa.ConsensusTensor import SubreadSetCircularConsensusTensors
+from biotk.libs.poa.ConsensusTensor import (SubreadSetCircularConsensusTensors,
+                                             kineticsScales,
+                                             rescaleTensorArray,
+                                             _initTensorWorker)
 from biotk.libs.QuickKinetics import kinetics
 from pbcore.io import ReferenceSet
+import numpy as np
+import pickle
+import pandas as pd
 
 class TestSubreadSetCircularConsensusTensors:
     def __init__(self, sset_path,
@@ -53,3 +59,160 @@ def test_subreadset_circular_consensus_tensors():
         kinetics_summary=kin_summary
     )
     print 'hello'
+
+def test_subreadset_circular_consensus_tensors_workers():
+    """
+    Test that a process pool gives the same tensors as a serial run
+    for the same seed
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    kwargs = dict(n_zmws_sample=4,
+                  min_coverage_depth=3,
+                  coverage_depth=4,
+                  tensors_context_width=1,
+                  tensors_collection_mode='standard',
+                  tensors_per_poa=10,
+                  seed=42)
+    serial = SubreadSetCircularConsensusTensors(sset_path, n_workers=1, **kwargs)
+    pooled = SubreadSetCircularConsensusTensors(sset_path, n_workers=2, zmws_per_batch=1, **kwargs)
+    assert pooled.consensus_tensor_lists is None
+    assert sorted(serial.consensus_tensor_lists) == sorted(pooled.consensus_tensor_arrays)
+    for zmw, tensor_list in serial.consensus_tensor_lists.items():
+        tensors, labels = pooled.consensus_tensor_arrays[zmw]
+        assert np.array_equal(tensor_list.tensors, tensors)
+        assert np.array_equal(tensor_list.labels, labels)
+
+def test_unseeded_workers_diverge():
+    """
+    Test that pool workers don't inherit the parent's random state when
+    no seed is set
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    builder = SubreadSetCircularConsensusTensors(sset_path, streaming=True)
+    config = pickle.loads(pickle.dumps(builder._workerConfig()))
+    draws = []
+    for _ in range(2):
+        np.random.seed(0)  # the state every forked worker would start from
+        _initTensorWorker(config)
+        draws.append(np.random.random_sample(4))
+    assert not np.array_equal(draws[0], draws[1])
+
+def test_prefetch_zmws():
+    """
+    Test that prefetching subreads in the background gives the same
+    tensors as fetching them in line
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    kwargs = dict(n_zmws_sample=4,
+                  min_coverage_depth=3,
+                  coverage_depth=4,
+                  tensors_context_width=1,
+                  tensors_per_poa=10,
+                  seed=7,
+                  streaming=True)
+    inline = SubreadSetCircularConsensusTensors(sset_path, **kwargs)
+    prefetched = SubreadSetCircularConsensusTensors(sset_path, prefetch_zmws=2, **kwargs)
+    results = zip(inline.iterTensorLists(), prefetched.iterTensorLists())
+    for (zmw, tensors, labels), (prefetched_zmw, prefetched_tensors, prefetched_labels) in results:
+        assert zmw == prefetched_zmw
+        assert np.array_equal(tensors, prefetched_tensors)
+        assert np.array_equal(labels, prefetched_labels)
+
+def test_iterTensorLists():
+    """
+    Test that streaming mode builds nothing up front and yields the same
+    tensors as an eager run
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    kwargs = dict(n_zmws_sample=3,
+                  min_coverage_depth=3,
+                  coverage_depth=4,
+                  tensors_context_width=1,
+                  tensors_per_poa=10,
+                  seed=7)
+    eager = SubreadSetCircularConsensusTensors(sset_path, **kwargs)
+    streamed = SubreadSetCircularConsensusTensors(sset_path, streaming=True, **kwargs)
+    assert streamed.consensus_tensor_lists is None
+    for zmw, tensors, labels in streamed.iterTensorLists():
+        assert np.array_equal(eager.consensus_tensor_lists[zmw].tensors, tensors)
+        assert np.array_equal(eager.consensus_tensor_lists[zmw].labels, labels)
+
+def test_rescaleTensorArray():
+    """
+    Test that stacked tensors are rescaled by the by-base kinetics
+    of their rows, in both mean and z-score modes
+    """
+    summary = pd.DataFrame({'PW_mean': [5., 6., 7., 8.],
+                            'IPD_mean': [10., 20., 30., 40.],
+                            'PW_std': [1., 2., 3., 4.],
+                            'IPD_std': [2., 3., 4., 5.]},
+                           index=['A', 'C', 'G', 'T'])
+    scales = kineticsScales(summary)
+    tensors = np.zeros((2, 5, 3, 3))
+    tensors[:, 2, :, 0] = 0.5  # half of 4 reads call T
+    tensors[:, 2, :, 1] = 24.
+    tensors[:, 2, :, 2] = 100.
+    rescaled = rescaleTensorArray(tensors.copy(), scales)
+    assert np.allclose(rescaled[:, 2, :, 1], 3.)
+    assert np.allclose(rescaled[:, 2, :, 2], 2.5)
+    assert np.all(rescaled[:, 0, :, 1:] == 0)
+
+    zscored = rescaleTensorArray(tensors.copy(), scales, mode='zscore', depth=4)
+    assert np.allclose(zscored[:, 2, :, 1], (24. - 2 * 8.) / (4. * np.sqrt(2)))
+    assert np.allclose(zscored[:, 2, :, 2], (100. - 2 * 40.) / (5. * np.sqrt(2)))
+    assert np.all(zscored[:, 1, :, 1:] == 0)
+
+def test_kinetics_rescale_mode():
+    """
+    Test that an unknown kinetics rescale mode is rejected by the
+    constructor, before any ZMW is aligned
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    try:
+        SubreadSetCircularConsensusTensors(sset_path, kinetics_rescale_mode='median')
+        assert False
+    except ValueError:
+        pass
+
+def test_screenZMWs():
+    """
+    Test that the pbi screen matches a groupby over flanked subreads, and
+    that the thresholds reject ZMWs before any POA
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    builder = SubreadSetCircularConsensusTensors(sset_path, streaming=True)
+    screen = builder.screenZMWs()
+    pbi = builder.pbi[builder.pbi['contextFlag'] == 3]
+    lengths = (pbi['qEnd'] - pbi['qStart']).groupby(pbi['holeNumber'])
+    expected_cvs = lengths.std(ddof=0) / lengths.mean()
+    assert np.allclose(screen.loc[expected_cvs.index, 'length_cv'], expected_cvs)
+    assert np.all(screen.loc[expected_cvs.index, 'n_subreads'] == lengths.size())
+
+    max_length_cv = np.nanmedian(screen['length_cv'].values)
+    builder = SubreadSetCircularConsensusTensors(sset_path,
+                                                 n_zmws_sample=2,
+                                                 min_coverage_depth=0,
+                                                 max_length_cv=max_length_cv,
+                                                 zmw_selection='ranked',
+                                                 streaming=True)
+    assert np.all(screen.loc[builder.zmws, 'length_cv'] <= max_length_cv)
+    assert list(screen.loc[builder.zmws, 'length_cv']) == sorted(screen.loc[builder.zmws, 'length_cv'])
+
+def test_sampleBalancedTensors():
+    """
+    Test that sampling nearly every ZMW never offers a ZMW twice, so no
+    (zmw, locus) is repeated in the reservoir
+    """
+    sset_path = 'data/tiny_set_internal.subreadset.xml'
+    builder = SubreadSetCircularConsensusTensors(sset_path, streaming=True)
+    nzmws = len(builder.zmws)
+    builder = SubreadSetCircularConsensusTensors(sset_path,
+                                                 n_zmws_sample=nzmws,
+                                                 coverage_depth=4,
+                                                 tensors_context_width=1,
+                                                 seed=3,
+                                                 streaming=True)
+    assert len(set(builder.zmws)) == len(builder.zmws) == nzmws
+    reservoir = builder.sampleBalancedTensors(50)
+    _, _, zmws, loci = reservoir.sample()
+    assert len(set(zip(zmws, loci))) == len(loci)
@@ -0,0 +1,40 @@
+from biotk.libs.poa import TensorReservoir as tr
+import numpy as np
+
+
+def _windows(n):
+    """
+    Context windows whose every entry is the window index
+    """
+    return np.repeat(np.arange(n, dtype=float), 5 * 3 * 3).reshape(n, 5, 3, 3)
+
+def test_offer():
+    """
+    Test that each label fills its own reservoir, and that stored tensors
+    are the windows of the accepted loci
+    """
+    reservoir = tr.StratifiedTensorReservoir(2, (5, 3, 3), seed=0)
+    labels = np.array(list('AAACCGT-'))
+    loci = np.arange(1, 9)  # context_width 1, window i is centered on column i + 1
+    assert reservoir.offer(11, _windows(8), loci, labels) == 7
+    assert list(reservoir.seen) == [3, 2, 1, 1, 1]
+    assert not reservoir.isFull()
+    tensors, sample_labels, zmws, sample_loci = reservoir.sample()
+    assert len(sample_loci) == 7
+    assert np.all(zmws == 11)
+    for tensor, label, locus in zip(tensors, sample_labels, sample_loci):
+        assert labels[locus - 1] == label
+        assert np.all(tensor == locus - 1)
+
+def test_no_duplicates():
+    """
+    Test that loci offered over several ZMWs are sampled without
+    duplicates once the reservoir is full
+    """
+    reservoir = tr.StratifiedTensorReservoir(4, (5, 3, 3), labels=['A'], seed=1)
+    for zmw in range(5):
+        reservoir.offer(zmw, _windows(6), np.arange(1, 7), ['A'] * 6)
+    assert reservoir.isFull()
+    assert list(reservoir.seen) == [30]
+    _, _, zmws, loci = reservoir.sample()
+    assert len(set(zip(zmws, loci))) == 4
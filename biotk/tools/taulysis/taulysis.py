@@ -8,6 +8,7 @@ import pickle
 import logging
 import random
 import pricompare.FastMetrics as fm
+from biotk.libs.PbiGroupIndex import PbiGroupIndex
 logging.basicConfig(level=logging.INFO)
 
 
@@ -432,16 +433,17 @@ def get_taus(alignment_set,
         writer = csv.DictWriter(file, fieldnames=fieldnames)
         writer.writeheader()
         
+    # group alignments by reference once, rather than scanning the index per reference
+    if is_legacy:
+        ref_index = PbiGroupIndex(alignment_set.index['RefGroupID'])
+    else:
+        ref_index = PbiGroupIndex(alignment_set.index['tId'])
+
     for ref in reference_information:
         logging.info(('Processing alignments from reference ' + 
                       str(ref['FullName'])))
         # row in recarray w/ 'ID', 'FullName', and 'SMRTBellSize'
-        if is_legacy:
-            aln_to_ref_indices = np.flatnonzero(alignment_set.index['RefGroupID'] ==
-                                                int(ref['ID']))
-        else:
-            aln_to_ref_indices = np.flatnonzero(alignment_set.index['tId'] ==
-                                                int(ref['ID']))
+        aln_to_ref_indices = ref_index.rows(int(ref['ID']))
 
         if len(aln_to_ref_indices) > 0: # check that there are alignments
             max_start_time = 5